@@ -1,114 +1,240 @@
 from sklearn.decomposition import LatentDirichletAllocation as LDA
 from sklearn.decomposition import PCA
 from sklearn.decomposition import TruncatedSVD as SVD
+from sklearn.decomposition import IncrementalPCA
+from sklearn.utils.extmath import randomized_svd
 from pandas import DataFrame
 from util import timed
-from functools import wraps
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
+from collections import OrderedDict, namedtuple
+from os import mkdir
+from os.path import isdir, isfile, join, abspath
+import hashlib
+import pickle
 
 
 
-def reindex(f):
+# a decomposition from Decompose.fit, with what is needed to project new vectors into it.
+Fit = namedtuple('Fit', ['reduced', 'components', 'mean', 'estimator', 'scaler'])
+
+class DecompositionCache():
     """
-    Wrapper to grab indexes from initial table and add them to the reduced table.
+    Results of decompositions, keyed by a content hash of the input table with k and the method,
+    so refitting the same table is replaced by a lookup. The most recently used results are kept
+    in memory (least recently used evicted first), and every result is also pickled to subdir
+    when one is given, so they outlive the process.
     """
-    @wraps(f)
-    def wrapper(table, k):
-        indexes = table.index
-        cols = table.columns
-        out, principle_comp = f(table, k)
-        return DataFrame(out, index=indexes, columns=range(k)), DataFrame(principle_comp, index=range(k), columns=cols)
-    return wrapper
 
-class Decompose():
+    def __init__(self, size=64, subdir=None):
+        """
+        :param int size: number of results to keep in memory.
+        :param path subdir: directory to store results on disk. Memory only if None.
+        """
+        self.size = size
+        self.subdir = subdir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
 
     @staticmethod
-    @reindex
-    def svd(table, k):
+    def key(table, k, method, variant=''):
         """
-        Decompose table into matrices U . S . V = table.
-        :param DataFrame table: table to decompose.
-        :param int k: number of components to get from decomposition.
-        :return DataFrame reduced matrix.
+        Hashes the contents (values, index and columns) of a table along with the decomposition.
+        :param DataFrame table: table that is decomposed.
+        :param int k: number of latent semantics.
+        :param str method: decomposition method.
+        :param str variant: which Decompose function produced the result, as they differ in output.
+        :return str: hex digest.
         """
-        matrix = SVD(n_components=k)
-        out = matrix.fit_transform(table)
-        return out, matrix.components_
+        digest = hashlib.sha1()
+        if hasattr(table, 'to_coo'):
+            # sparse (term space) tables are hashed by their nonzeros rather than densified.
+            coo = table.to_coo()
+            for array in (coo.row, coo.col, coo.data):
+                digest.update(np.ascontiguousarray(array).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(np.asarray(table, dtype=np.float64)).tobytes())
+        digest.update(repr(list(table.index)).encode())
+        digest.update(repr(list(table.columns)).encode())
+        digest.update(repr((k, method, variant)).encode())
+        return digest.hexdigest()
 
-    @staticmethod
-    @reindex
-    def pca(table, k):
+
+    def __location__(self, key):
+        return abspath(join(self.subdir, key + '.pickle'))
+
+
+    def get(self, key):
         """
-        Decompose table into matrices V . L . V^{T} = table and returns the obj matrix.
-        :param DataFrame table: table to decompose.
-        :param int k: number of components to get from decomposition.
-        :return DataFrame reduced matrix.
+        :return: the stored result, or None if the key is not cached.
         """
-        matrix = PCA(n_components=k)
-        out = matrix.fit_transform(table)
-        return out, matrix.components_
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.subdir and isfile(self.__location__(key)):
+            with open(self.__location__(key), 'rb') as f:
+                value = pickle.load(f)
+            self.__remember__(key, value)
+            return value
+        return None
 
 
-    @staticmethod
-    @reindex
-    def lda(table, k):
+    def put(self, key, value):
+        self.__remember__(key, value)
+        if self.subdir:
+            if not isdir(self.subdir):
+                mkdir(self.subdir)
+            with open(self.__location__(key), 'wb+') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def __remember__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def fetch(self, table, k, method, variant, compute):
         """
-        Decompose table into matrices U . S . V^{T} = table and returns the obj matrix.
+        Gets the decomposition of the table, computing (and storing) it only on a miss.
         :param DataFrame table: table to decompose.
-        :param int k: number of components to get from decomposition.
-        :return DataFrame reduced matrix.
+        :param int k: number of latent semantics.
+        :param str method: decomposition method.
+        :param str variant: name of the Decompose function.
+        :param function compute: called with no arguments to run the decomposition.
         """
-        matrix = LDA(n_components=k)
-        out = matrix.fit_transform(table)
-        return out, matrix.components_
+        key = DecompositionCache.key(table, k, method, variant)
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            value = compute()
+            self.put(key, value)
+        else:
+            self.hits += 1
+        return value
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+
+class Decompose():
+
+    # shared by every decomposition below which has no side effects (printing). Replace with
+    #   DecompositionCache(subdir=...) to also keep results on disk.
+    cache = DecompositionCache()
 
-    
     @staticmethod
-    def switchboard(table, k, method):
+    def fit(table, k, method, scale=False, batch_size=1024, n_oversamples=10, n_iter=4, dtype=np.float64):
         """
-        Selects the method to run based on the method name. Useful for every
-        :param DataFrame table: the table to reduce.
-        :param int k: The number of latent semantics to use.
-        :param str method: The method of decomposition to use (pca, lda, svd)
-        :return DataFrame with reduced objects.
+        Runs a decomposition and keeps what is needed to project new vectors later. rsvd is a
+            randomized SVD over a random projection onto k + n_oversamples dimensions, refined by
+            n_iter power iterations, that never densifies sparse tables. ipca is incremental PCA,
+            holding only one dense batch of batch_size rows in memory at a time.
+        :param DataFrame table: table to decompose.
+        :param int k: number of components to get from decomposition.
+        :param str method: The method of decomposition to use (pca, lda, svd, rsvd, ipca)
+        :param bool scale: min max scale the features first (done for lda on visual data).
+        :param int batch_size: rows per batch of ipca.
+        :param int n_oversamples: oversamples of rsvd.
+        :param int n_iter: power iterations of rsvd.
+        :param numpy.dtype dtype: precision of the decomposition.
+        :return Fit: the reduced table and components as arrays, with the feature means removed
+            before projecting, the fitted estimator (None for rsvd) and the scaler (None if unscaled).
         """
-        if method == 'pca':
-            f = Decompose.pca
-        elif method == 'svd':
-            f = Decompose.svd
+        matrix = Decompose.__matrix__(table, dtype)
+        scaler = None
+        if scale:
+            scaler = MinMaxScaler()
+            matrix = scaler.fit_transform(Decompose.__dense__(matrix, 0, matrix.shape[0]))
+
+        estimator = None
+        mean = None
+        if method == 'svd':
+            estimator = SVD(n_components=k)
+            out = estimator.fit_transform(matrix)
+        elif method == 'pca':
+            estimator = PCA(n_components=k)
+            out = estimator.fit_transform(Decompose.__dense__(matrix, 0, matrix.shape[0]))
+            mean = estimator.mean_
         elif method == 'lda':
-            f = Decompose.lda
+            estimator = LDA(n_components=k)
+            out = estimator.fit_transform(matrix)
+        elif method == 'rsvd':
+            _, _, VT = randomized_svd(matrix, k, n_oversamples=n_oversamples, n_iter=n_iter, random_state=0)
+            # the exact projection onto VT rather than U * S, so new vectors land consistently.
+            return Fit(matrix.dot(VT.T), VT, None, None, scaler)
+        elif method == 'ipca':
+            estimator = IncrementalPCA(n_components=k)
+            batches = Decompose.__batches__(matrix.shape[0], batch_size, k)
+            for start, stop in batches:
+                estimator.partial_fit(Decompose.__dense__(matrix, start, stop))
+            out = np.vstack([estimator.transform(Decompose.__dense__(matrix, start, stop)) for start, stop in batches])
+            mean = estimator.mean_
         else:
             raise ValueError("Invalid decomposition method specified: " + method)
 
-        return f(table, k)
+        return Fit(out, estimator.components_, mean, estimator, scaler)
 
+    @staticmethod
+    def __batches__(rows, batch_size, k):
+        """
+        (start, stop) row ranges of batch_size rows, each holding at least k rows.
+        """
+        batch_size = max(batch_size, k)
+        # fold a short final batch into the one before it, as every batch needs k rows.
+        bounds = list(range(0, rows, batch_size)) + [rows]
+        if len(bounds) > 2 and bounds[-1] - bounds[-2] < k:
+            del bounds[-2]
+        return list(zip(bounds[:-1], bounds[1:]))
 
     @staticmethod
-    def decompose_text(term_space, k, method, database):
+    def __dense__(matrix, start, stop):
+        """
+        Rows start to stop of a dense or sparse matrix, as a dense array.
         """
-        Used by task1 and task2.
-        :param str term_space: The type of term space to grab. (user, photo, location)
+        block = matrix[start:stop]
+        return block.toarray() if hasattr(block, 'toarray') else np.asarray(block)
+
+    @staticmethod
+    def __matrix__(table, dtype):
+        """
+        The values of a table in the given precision, as a CSR matrix if the table is sparse.
+        """
+        if hasattr(table, 'to_coo'):
+            return table.to_coo().tocsr().astype(dtype)
+        return np.asarray(table, dtype=dtype)
+
+    
+    @staticmethod
+    def switchboard(table, k, method, **kwargs):
+        """
+        Selects the method to run based on the method name. Useful for every
+        :param DataFrame table: the table to reduce.
         :param int k: The number of latent semantics to use.
-        :param str method: The method of decomposition to use (pca, lda, svd)
-        :return DataFrame with reduced objects and latent semantics.
+        :param str method: The method of decomposition to use (pca, lda, svd, rsvd, ipca)
+        :param kwargs: passed to Decompose.fit, such as scale, or n_oversamples, n_iter,
+            batch_size or dtype of rsvd and ipca.
+        :return DataFrame with reduced objects.
         """
-        table = database.get_txt_desc_table(term_space)
-        reduced, principle_comp = Decompose.switchboard(table, k, method)
-        return reduced, principle_comp
+        fit = Decompose.fit(table, k, method, **kwargs)
+        return DataFrame(fit.reduced, index=table.index, columns=range(k)), \
+            DataFrame(fit.components, index=range(k), columns=table.columns)
     
 
     @staticmethod
-    def decompose_loc(k, method, locationid, database):
+    def decompose_loc(k, method, locationid, database, **kwargs):
         table = database.get_vis_table(locationid=locationid)
-        if method == 'lda':
-            scalar = MinMaxScaler()
-            indexes = table.index
-            cols = table.columns
-            table = scalar.fit_transform(table)
-            table = DataFrame(table, columns=cols, index=indexes)
-        reduced, ps = Decompose.switchboard(table, k, method)
+        return Decompose.cache.fetch(table, k, method, 'decompose_loc' + repr(sorted(kwargs.items())),
+                                     lambda: Decompose.__decompose_loc__(table, k, method, **kwargs))
+
+    @staticmethod
+    def __decompose_loc__(table, k, method, **kwargs):
+        reduced, ps = Decompose.switchboard(table, k, method, scale=method == 'lda', **kwargs)
         return reduced, ps
 
     ########################################################################################
@@ -127,7 +253,8 @@ class Decompose():
     @staticmethod
     def decompose_loc_vis2(model, k, method, locationid, database):
         table = database.get_vis_table(model=model, locationid=locationid)
-        return Decompose.switchboard2(table, k, method)
+        return Decompose.cache.fetch(table, k, method, 'switchboard2',
+                                     lambda: Decompose.switchboard2(table, k, method))
     
     @staticmethod
     def switchboard2(table, k, method):
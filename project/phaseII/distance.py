@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 class Distance():
     
     @staticmethod
@@ -42,16 +43,51 @@ class Similarity():
 
 class Scoring():
 
+    METHODS = ['greedy', 'hungarian']
+
     @staticmethod
-    def score_matrix(sim_matrix):
-        similarity = 0
+    def score_matrix(sim_matrix, method='greedy'):
+        """
+        Scores how well the rows of a similarity matrix match its columns (see below).
+        :param numpy.ndarray sim_matrix: (m x n) similarity matrix.
+        :param str method: 'greedy' (repeatedly take the largest remaining value) or 'hungarian'
+            (the one to one matching with the largest total).
+        :return float: matched similarity over the average of m and n.
+        """
+        sim_matrix = np.asarray(sim_matrix)
         denominator = sum(sim_matrix.shape) / 2
-        for i in range(min(sim_matrix.shape)):
-            x, y = np.where(sim_matrix == np.max(sim_matrix))[0][0], np.where(sim_matrix == np.max(sim_matrix))[1][0]
-            similarity += sim_matrix[x, y]
-            sim_matrix = np.delete(sim_matrix, (x), axis=0)
-            sim_matrix = np.delete(sim_matrix, (y), axis=1)
-        return similarity / denominator
+        if method == 'greedy':
+            rows, cols = Scoring.greedy(sim_matrix)
+        elif method == 'hungarian':
+            rows, cols = linear_sum_assignment(-sim_matrix)
+        else:
+            raise ValueError('Invalid scoring method specified: %s' % method)
+        return sim_matrix[rows, cols].sum() / denominator
+
+    @staticmethod
+    def greedy(sim_matrix):
+        """
+        Greedy matching: the largest value whose row and column are both unused is taken until the
+        rows or columns run out. Values are visited once in descending order (ties in row major
+        order, as the first np.where match was), with masks marking the used rows and columns in
+        place of deleting them from the matrix.
+        :param numpy.ndarray sim_matrix: (m x n) similarity matrix.
+        :return tuple (rows, cols): positions of the matched values.
+        """
+        m, n = sim_matrix.shape
+        order = np.argsort(-sim_matrix, axis=None, kind='stable')
+        used_rows = np.zeros(m, dtype=bool)
+        used_cols = np.zeros(n, dtype=bool)
+        rows, cols = [], []
+        for x, y in zip(*np.divmod(order, n)):
+            if used_rows[x] or used_cols[y]:
+                continue
+            used_rows[x] = used_cols[y] = True
+            rows.append(x)
+            cols.append(y)
+            if len(rows) == min(m, n):
+                break
+        return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
 
     # Explanation of the above algorithm to find a similarity score for a similarity matrix:
     # Sum of max. vals is equal to 0.
@@ -0,0 +1,176 @@
+from sklearn.neighbors import NearestNeighbors
+from pandas import DataFrame
+from os.path import isfile
+from decompose import Decompose, DecompositionCache
+from neighbor import DistanceMeasure
+from util import timed
+import numpy as np
+import pickle
+
+
+class LatentModel():
+    """
+    A decomposition fitted once (in task 1 or the first query) and kept for every later query. It
+    holds what is needed to place any vector in the latent space (the fitted estimator, its
+    components and mean, and the scaler applied before it) along with the reduced table, and
+    answers nearest neighbor queries from an index built over the reduced table on first use.
+    """
+
+    def __init__(self, ids, columns, k, method, reduced, components, mean=None, estimator=None, scaler=None,
+                 fingerprint=None):
+        """
+        :param list ids: object id of each row of the table.
+        :param list columns: features of the table.
+        :param int k: number of latent semantics.
+        :param str method: decomposition method (pca, lda, svd, rsvd, ipca).
+        :param numpy.ndarray reduced: (objects x k) table in the latent space.
+        :param numpy.ndarray components: (k x features) latent semantics.
+        :param numpy.ndarray mean: feature means removed before projecting. None for no centering.
+        :param estimator: fitted sklearn estimator. If None, vectors are projected linearly with
+            the components and mean.
+        :param MinMaxScaler scaler: fitted scaler applied before projecting. None for no scaling.
+        :param str fingerprint: LatentModel.key of what the model was fitted on.
+        """
+        self.ids = list(ids)
+        self.columns = list(columns)
+        self.k = k
+        self.method = method
+        self.reduced = np.asarray(reduced, dtype=np.float64)
+        self.components = np.asarray(components)
+        self.mean = mean
+        self.estimator = estimator
+        self.scaler = scaler
+        self.fingerprint = fingerprint
+        self.__rows__ = {an_id: row for row, an_id in enumerate(self.ids)}
+        self.__indexes__ = {}
+
+
+    @staticmethod
+    def key(table, k, method, scale=False, **kwargs):
+        """
+        Content hash of the table along with everything the fit depends on.
+        :return str: hex digest.
+        """
+        return DecompositionCache.key(table, k, method, 'latent' + repr((scale, sorted(kwargs.items()))))
+
+
+    @staticmethod
+    @timed
+    def fit(table, k, method, scale=False, **kwargs):
+        """
+        Fits a decomposition of the table with Decompose.fit.
+        :param DataFrame table: objects as rows, features as columns.
+        :param int k: number of latent semantics.
+        :param str method: decomposition method (pca, lda, svd, rsvd, ipca).
+        :param bool scale: min max scale the features before fitting (done for lda on visual data).
+        :param kwargs: options of the method, see Decompose.fit.
+        :return LatentModel:
+        """
+        fit = Decompose.fit(table, k, method, scale=scale, **kwargs)
+        return LatentModel(table.index, table.columns, k, method, fit.reduced, fit.components, fit.mean,
+                           fit.estimator, fit.scaler, LatentModel.key(table, k, method, scale, **kwargs))
+
+
+    def matches(self, key):
+        """
+        If the model was fitted on the table, k, method and options hashed by LatentModel.key.
+        """
+        return getattr(self, 'fingerprint', None) == key
+
+
+    def transform(self, vectors):
+        """
+        Projects new vectors into the latent space.
+        :param numpy.ndarray vectors: (n x features) vectors, or a single (features,) vector.
+        :return numpy.ndarray: (n x k) latent vectors.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+        if self.scaler is not None:
+            vectors = self.scaler.transform(vectors)
+        if self.estimator is not None:
+            return self.estimator.transform(vectors)
+        if self.mean is not None:
+            vectors = vectors - self.mean
+        return vectors.dot(self.components.T)
+
+
+    def vector(self, an_id):
+        """
+        :return numpy.ndarray: (k,) latent vector of an object of the fitted table.
+        """
+        if not an_id in self.__rows__:
+            raise ValueError('The id is not in the latent model: %s' % an_id)
+        return self.reduced[self.__rows__[an_id]]
+
+
+    def semantics(self):
+        """
+        :return DataFrame: latent semantics as rows, features as columns.
+        """
+        return DataFrame(self.components, index=range(self.k), columns=self.columns)
+
+
+    def table(self):
+        """
+        :return DataFrame: the reduced table, indexed by object id.
+        """
+        return DataFrame(self.reduced, index=self.ids, columns=range(self.k))
+
+
+    def __neighbors__(self, metric, p):
+        """
+        Nearest neighbor index over the reduced table, built once for each metric.
+        """
+        if not (metric, p) in self.__indexes__:
+            if metric == 'cosine':
+                index = NearestNeighbors(metric='cosine', algorithm='brute')
+            else:
+                index = NearestNeighbors(metric=metric, p=p)
+            self.__indexes__[metric, p] = index.fit(self.reduced)
+        return self.__indexes__[metric, p]
+
+
+    def nearest(self, j, vector, metric='minkowski', p=3, absolute=False):
+        """
+        The j objects nearest to a latent vector.
+        :param numpy.ndarray vector: (k,) latent vector, from vector() or transform().
+        :param int j: number of objects to return.
+        :param str metric: 'minkowski' (with order p) or 'cosine' (distance 1 - similarity).
+        :param int p: order of the minkowski distance.
+        :param bool absolute: for cosine, rank by the absolute similarity, so opposite vectors are
+            as near as identical ones.
+        :return list: DistanceMeasure for the j nearest, nearest first.
+        """
+        index = self.__neighbors__(metric, p)
+        j = min(j, len(self.ids))
+        queries = [vector, -np.asarray(vector)] if absolute and metric == 'cosine' else [vector]
+
+        best = {}
+        for query in queries:
+            distances, rows = index.kneighbors(np.atleast_2d(query), n_neighbors=j)
+            for distance, row in zip(distances[0], rows[0]):
+                best[row] = min(distance, best.get(row, np.inf))
+
+        nearest = sorted(best.items(), key=lambda pair: pair[1])[:j]
+        return [DistanceMeasure(self.ids[row], distance) for row, distance in nearest]
+
+
+    def save(self, location):
+        """
+        Saves the model to binary so it can be reused without refitting.
+        :param path location: location to save to.
+        """
+        with open(location, 'wb+') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load a model from binary.
+        :param path location: location to read from.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with open(location, 'rb') as f:
+            return pickle.load(f)
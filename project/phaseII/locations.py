@@ -0,0 +1,136 @@
+from distance import Scoring
+from decompose import DecompositionCache
+from pandas import DataFrame
+from os.path import isfile
+from util import timed
+import numpy as np
+import pickle
+
+
+class LocationSimilarity():
+    """
+    Location - location similarity, where the score of a pair of locations is the Scoring of the
+    cosine similarities between their images. Every image is normalized once, so the cosine
+    similarities of one location to all others are a single matrix product against the stacked
+    images of every location. Scores are cached, and when the images of a location change only
+    the pairs involving that location are recomputed.
+    """
+
+    def __init__(self, method='greedy'):
+        """
+        :param str method: Scoring method, 'greedy' or 'hungarian'.
+        """
+        if not method in Scoring.METHODS:
+            raise ValueError('Invalid scoring method specified: %s' % method)
+        self.method = method
+        self.locations = []
+        self.fingerprints = {}
+        self.groups = {}
+        self.scores = {}
+        self.__stacked__ = None
+        self.__offsets__ = None
+
+
+    def update(self, tables):
+        """
+        Sets the images of every location. Locations whose images are unchanged keep their scores.
+        :param dict tables: maps each location id to a DataFrame of its images (rows) and features.
+        :return set: locations that were added or changed.
+        """
+        changed = set()
+        for location, table in tables.items():
+            fingerprint = DecompositionCache.key(table, 0, '', 'location')
+            matrix = np.asarray(table, dtype=np.float64)
+            norms = np.linalg.norm(matrix, axis=1)
+            norms[norms == 0] = 1
+            self.groups[location] = matrix / norms[:, np.newaxis]
+            if self.fingerprints.get(location) != fingerprint:
+                self.fingerprints[location] = fingerprint
+                changed.add(location)
+
+        for location in set(self.fingerprints) - set(tables):
+            del self.fingerprints[location]
+            self.groups.pop(location, None) # not persisted, absent after load.
+            changed.add(location)
+
+        # forget every score involving a changed location.
+        self.scores = {pair: score for pair, score in self.scores.items() if not (set(pair) & changed)}
+        self.locations = sorted(tables)
+        self.__stacked__ = None
+        return changed
+
+
+    def __stack__(self):
+        """
+        All normalized images in one matrix, with the row offset of each location.
+        """
+        if self.__stacked__ is None:
+            self.__stacked__ = np.vstack([self.groups[location] for location in self.locations])
+            sizes = [len(self.groups[location]) for location in self.locations]
+            self.__offsets__ = dict(zip(self.locations, zip(np.cumsum(sizes) - sizes, np.cumsum(sizes))))
+        return self.__stacked__, self.__offsets__
+
+
+    def row(self, location):
+        """
+        Similarity of a location to every location, computing only the missing pairs.
+        :param location: location id.
+        :return dict: maps every location id to its score.
+        """
+        if not location in self.groups:
+            raise ValueError('Location has no images loaded: %s' % location)
+
+        missing = [other for other in self.locations if not (location, other) in self.scores]
+        if missing:
+            stacked, offsets = self.__stack__()
+            # cosine similarity of this location's images to every image, in one product.
+            similarity = self.groups[location].dot(stacked.T)
+            for other in missing:
+                start, stop = offsets[other]
+                score = Scoring.score_matrix(similarity[:, start:stop], method=self.method)
+                self.scores[location, other] = score
+                self.scores[other, location] = score
+
+        return {other: self.scores[location, other] for other in self.locations}
+
+
+    @timed
+    def matrix(self):
+        """
+        :return DataFrame: (locations x locations) similarity matrix.
+        """
+        rows = [self.row(location) for location in self.locations]
+        return DataFrame([[row[other] for other in self.locations] for row in rows],
+                         index=self.locations, columns=self.locations)
+
+
+    def __getstate__(self):
+        # images are reloaded by update, only the scores and what they were computed from persist.
+        return {'method': self.method, 'locations': self.locations, 'fingerprints': self.fingerprints,
+                'scores': self.scores}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['method'])
+        self.__dict__.update(state)
+
+
+    def save(self, location):
+        """
+        Saves the scores to binary so unchanged locations are not rescored after a restart.
+        :param path location: location to save to.
+        """
+        with open(location, 'wb+') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load scores from binary. update must be called before they are used.
+        :param path location: location to read from.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with open(location, 'rb') as f:
+            return pickle.load(f)
@@ -1,10 +1,10 @@
 from neighbor import Neighbor
 from decompose import Decompose
+from latent import LatentModel
+from locations import LocationSimilarity
 from loader import Loader
 from database import Database
 from os.path import isfile, abspath, isdir
-from distance import Scoring
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.decomposition import TruncatedSVD as SVD
 import numpy as np
 from pandas import DataFrame as df
@@ -30,6 +30,8 @@ class Interface():
 
     def __init__(self, demo_load=False):
         self.__database__ = None
+        self.__latent__ = {}
+        self.__location_similarity__ = {}
         self.__valid_types__ = ['photo', 'user', 'poi']
         self.__vis_models__ = ['CM', 'CM3x3', 'CN', 'CN3x3',
                 'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
@@ -59,6 +61,31 @@ class Interface():
 
 
 
+    def __latent_model__(self, space, table, k, method, scale=False):
+        """
+        The latent model of a space (('text', term space) or ('vis', model)) for k and method. Reuses
+        the model in memory, then the one saved to disk, and only fits (and saves) a new one if
+        neither was fitted on the same table contents.
+        :param tuple space: which table the model is for.
+        :param DataFrame table: the table of the space.
+        :param int k: number of latent semantics.
+        :param str method: decomposition method.
+        :param bool scale: min max scale the table before fitting.
+        :return LatentModel:
+        """
+        key = LatentModel.key(table, k, method, scale)
+        model = self.__latent__.get(space)
+        if model is None or not model.matches(key):
+            location = abspath('latent_' + '_'.join(space) + '.pickle')
+            model = LatentModel.load(location) if isfile(location) else None
+            if model is None or not model.matches(key):
+                model = LatentModel.fit(table, k, method, scale=scale)
+                model.save(location)
+            self.__latent__[space] = model
+        return model
+
+
+
     def __io__(self):
         print("Welcome to the CSE 515 data software. Please enter a command.\
               \nEnter \"help\" for a list of commands.")
@@ -134,7 +161,7 @@ class Interface():
         Arguments:
         \tTerm Space - What text description type to pull. (user, photo, poi)
         \tK - Number of latent semantics to return.
-        \tMethod - The decomposition method to use. (PCA, SVD, LDA)
+        \tMethod - The decomposition method to use. (PCA, SVD, LDA, RSVD, IPCA)
         """
 
         if len(args) < 3:
@@ -157,13 +184,15 @@ class Interface():
         except:
             print("[ERROR] One or more arguments could not be parsed: " + str(args))
 
-        _, latent_semantics = Decompose.decompose_text(term_space, k, method.lower(), self.__database__)
-        string = self.__latent_semantic_string__(latent_semantics)
+        # the fitted model is kept for task 2.
+        table = self.__database__.get_txt_desc_table(term_space)
+        model = self.__latent_model__(('text', term_space), table, k, method.lower())
+        string = self.__latent_semantic_string__(model.semantics())
         return string
 
 
 
-    # TODO - this should be implemented so it can follow Task 1, not be restarted
+    # Follows Task 1 - the latent model fitted there is reused rather than restarted
     #   from scratch.
     def task2(self, *args):
         """
@@ -173,7 +202,7 @@ class Interface():
         Arguments:
         \tTerm Space - What text description type to pull. (user, photo, poi).
         \tK - Number of latent semantics to return.
-        \tMethod - The decomposition method to use. (PCA, SVD, LDA).
+        \tMethod - The decomposition method to use. (PCA, SVD, LDA, RSVD, IPCA).
         \tJ - Number of nearest terms to find.
         \tID - The id to find nearest neighbors to using the latent semantics.
         """
@@ -201,11 +230,12 @@ class Interface():
         except:
             print("[ERROR] One or more arguments could not be parsed: " + str(args))
 
-        reduced_table, latent_semantics = Decompose.decompose_text(term_space, k, method.lower(), self.__database__)
-        ls_str = self.__latent_semantic_string__(latent_semantics)
+        table = self.__database__.get_txt_desc_table(term_space)
+        model = self.__latent_model__(('text', term_space), table, k, method.lower())
+        ls_str = self.__latent_semantic_string__(model.semantics())
         print(ls_str)
-        vector = reduced_table.loc[anid]
-        neighbors = Neighbor.knn(j, vector, reduced_table)
+        vector = model.vector(anid)
+        neighbors = model.nearest(j, vector)
         neighbors_str = ""
         neighbors_str += "NEIGHBORS to " + str(anid)
         for i, neighbor in enumerate(neighbors):
@@ -215,8 +245,8 @@ class Interface():
 
 
 
-    # TODO - This should also be reimplemented so the query for j nearest can be done
-    #   after the initial query, rather than from scratch.
+    # The latent model is fitted once per visual model, so the query for j nearest
+    #   after the initial query only searches its prebuilt index.
     def task3(self, *args):
         """
         Command:\ttask3 <vis model> <k> <method> <j> <id>
@@ -253,18 +283,20 @@ class Interface():
             print("[ERROR] One or more arguments could not be parsed: " + str(args))
 
         # Get latent semantics.
-        matrix = Decompose.decompose_vis(vis_model, k, method, self.__database__)
-
-        # Get nearest images from latent semantics.
-        vector = matrix.loc[anid]
-        vector1 = []
-        for i in range(k):
-            vector1.append(vector[i])
-        nearest_img = "5 nearest images to " + str(args[3]) + " are:\n"
-        nearest = Neighbor.knn_dot(5, vector1, matrix)
+        table = self.__database__.get_vis_table(model=vis_model)
+        model = self.__latent_model__(('vis', vis_model), table, k, method, scale=method == 'lda')
+        for l, semantic in enumerate(model.components):
+            print("LATENT SEMANTICS " + str(l))
+            for i, comp in enumerate(semantic):
+                print(str(i) + "\t" + str(comp))
+
+        # Get nearest images from latent semantics, scored by absolute cosine similarity.
+        vector1 = list(model.vector(anid))
+        nearest_img = str(j) + " nearest images to " + str(anid) + " are:\n"
+        nearest = model.nearest(j, vector1, metric='cosine', absolute=True)
         nearest_img += "IMAGE ID\t\tSCORE\n"
         for values in nearest:
-            nearest_img += str(values[1]) + "\t\t" + str(values[0]) + '\n'
+            nearest_img += str(values.id) + "\t\t" + str(1 - values.dist) + '\n'
         print(nearest_img)
 
         # Get nearest locations from latent semantics.
@@ -326,21 +358,22 @@ class Interface():
 
     def task5(self, *args):
         """
-        Command:\ttask5 <locationid> <k> <method>
+        Command:\ttask5 <locationid> <k> <method> [scoring]
         Description:\tIdentifies the top k latent semantics for the location id \
         across all models and identifies the top 5 related locations to the \
         latent semantics.
         Arguments:
         \tLocation Id - A valid location id. (1 - 30)
         \tK - Number of latent semantics to identify.
-        \tMethod - The decomposition method to use. (PCA, SVD, LDA).
+        \tMethod - The decomposition method to use. (PCA, SVD, LDA, RSVD, IPCA).
+        \tScoring - How image similarities are matched into a location score. (greedy, hungarian)
         """
         if len(args) < 3:
             print("[ERROR] Not enough args were provided. Expected 3 but got " + str(len(args)))
             print("\targs = " + str(args))
             return
-        if len(args) > 3:
-            print("[ERROR] Too many arguments were provided. Expected 3 but got " + str(len(args)))
+        if len(args) > 4:
+            print("[ERROR] Too many arguments were provided. Expected 4 but got " + str(len(args)))
             print("\targs = " + str(args))
             return
         if not self.__database__:
@@ -352,6 +385,7 @@ class Interface():
             locationid = int(args[0])
             k = int(args[1])
             method = args[2]
+            scoring = args[3].lower() if len(args) > 3 else 'greedy'
         except:
             print("[ERROR] One or more arguments could not be parsed: " + str(args))
 
@@ -360,18 +394,19 @@ class Interface():
         # reduced_table.to_csv('Image-semantic_task5.csv')
         self.__latent_semantic_string__(latent_semantics)
         reducedLocations = dict()  # A dictionary that has locationid as the key and the reduced tables as the values.
-        similarityScore = dict()
         for i in range(1,36):
             if i == locationid:
                 reducedLocations[i] = reduced_table
             else:
                 rtable, _ = Decompose.decompose_loc(k, method, i, self.__database__)
                 reducedLocations[i] = rtable
-            sim = cosine_similarity(reduced_table,reducedLocations[i])
-            # The dot_similarity (matrix, matrix) returns a 2D array that has ids of one location as rows, and another location's id as columns.
-            # The values are the similarity between each id (Just like a similarity matrix).
-
-            similarityScore[i] = Scoring.score_matrix(sim)
+        # One engine per latent space. Only this location's row of scores is computed, and it is
+        #   kept for later queries until the reduced tables change.
+        engine = self.__location_similarity__.get((k, method, scoring))
+        if engine is None:
+            engine = self.__location_similarity__[k, method, scoring] = LocationSimilarity(scoring)
+        engine.update(reducedLocations)
+        similarityScore = engine.row(locationid)
         orderedSimilarityList = sorted(similarityScore, key=similarityScore.__getitem__) # returns a list containing the Locations ids in the increasing order of the similarity
         orderedSimilarityList.reverse()  # Reverse the list to get it in the decreasing order
         print (similarityScore)
@@ -382,18 +417,19 @@ class Interface():
 
     def task6(self, *args):
         """
-        Command:\ttask6 <k>
+        Command:\ttask6 <k> [scoring]
         Description:\tCreates a location - location similarity matrix, performs SVD, \
         and reports the top k latent semantics.
         Arguments:
         \tK - Number of latent semantics to identify.
+        \tScoring - How image similarities are matched into a location score. (greedy, hungarian)
         """
         if len(args) < 1:
             print("[ERROR] Not enough args were provided. Expected 1 but got " + str(len(args)))
             print("\targs = " + str(args))
             return
-        if len(args) > 1:
-            print("[ERROR] Too many arguments were provided. Expected 1 but got " + str(len(args)))
+        if len(args) > 2:
+            print("[ERROR] Too many arguments were provided. Expected 2 but got " + str(len(args)))
             print("\targs = " + str(args))
             return
         if not self.__database__:
@@ -403,6 +439,7 @@ class Interface():
 
         try:
             k = int(args[0])
+            scoring = args[1].lower() if len(args) > 1 else 'greedy'
         except:
             print("[ERROR] One or more arguments could not be parsed: " + str(args))
 
@@ -412,24 +449,16 @@ class Interface():
         all_location_tables = dict()
         for id in range(1,36):
             all_location_tables[id] = Database.get_vis_table(self.__database__,locationid=id)
-        # Start finding the similarity between each pair of locations and store the results into a dictionary.
-        if isfile('./all_similarities.npy'):
-            all_similarities = np.load('all_similarities.npy').item()
-        else:
-            all_similarities = dict()
-            for i in range(1,36):
-                for j in range(i,36):
-                    cos_sim = cosine_similarity(all_location_tables[i], all_location_tables[j])
-                    all_similarities[(i, j)] = Scoring.score_matrix(cos_sim)
-                    all_similarities[(j, i)] = all_similarities[(i, j)]
-            np.save('all_similarities.npy', all_similarities)
-
-        similarity_matrix = df(index=range(1,36),columns=range(1,36))
-        for i in range(1,36):
-            sim_list = list()
-            for j in range(1,36):
-                sim_list.append(all_similarities[(i, j)])
-            similarity_matrix.loc[i] = sim_list
+        # Find the similarity between each pair of locations. Scores are saved, and only the pairs
+        #   involving locations whose images changed since are recomputed.
+        saved = f'location_similarity_{scoring}.pickle'
+        engine = self.__location_similarity__.get(('vis', scoring))
+        if engine is None:
+            engine = LocationSimilarity.load(saved) if isfile(saved) else LocationSimilarity(scoring)
+            self.__location_similarity__['vis', scoring] = engine
+        engine.update(all_location_tables)
+        similarity_matrix = engine.matrix()
+        engine.save(saved)
         similarity_matrix.to_csv('Task6_SimilarityMatrix.csv')
         print("Location-Location Similarity matrix created...")
 
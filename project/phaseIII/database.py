@@ -3,9 +3,11 @@
 import pandas as pd
 from os import listdir, mkdir
 from os.path import basename, join, isfile, splitext, split, isdir, abspath
-from csv import reader
 from util import timed
 from collections import defaultdict
+from features import FeatureStore
+from multiprocessing import Pool
+import numpy as np
 import pickle
 
 class Database():
@@ -16,7 +18,9 @@ class Database():
         self.source = source # indicates the dataset file location. 
         self.vis_descriptors = {}
         self.vis = None
-        # self.txt_descriptors = {}
+        self.features = None
+        self.__locs__ = None
+        self.txt_descriptors = {}
         self.locations = None
         self.vis_models = ['CM', 'CM3x3', 'CN', 'CN3x3', 'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
         self.loc_map = {}
@@ -47,29 +51,21 @@ class Database():
     ##
     # Stores textual descriptors data.
     #
-    # txt_descriptors dictionary of dictionaries mapping from:
-    #   id -> [(term tf idf tfidf), ...]
-    # each dictionary corresponding to locations, photos, users.
+    # txt_descriptors dictionary of TermStores (see DescriptionReader), one
+    #   for each of locations, photos, users. Rows are sorted by id.
     #
-    # NOTE id is not the key, as id's will repeat. (each id has multiple terms)
+    # NOTE the poi rows are relabelled from location names to location ids.
     def add_txt_descriptors(self, txt_descriptors):
 
-        for desc_type, table in txt_descriptors.items():
+        for desc_type, store in txt_descriptors.items():
 
             if desc_type == 'poi':
-                old_table = dict(table)
-                table = {}
                 # we want to change the location names to the location ids
-                #rows = [ [self.get_location_by_name(row[0])['id']] + row[1:] for row in rows]
-                for poi_name in old_table.keys():
-                    table[self.get_location_by_name(poi_name).name] = old_table[poi_name]
-                # Manually delete old_table from memory - memory is maxed out otherwise
-                del(old_table)
-
-            b = pd.DataFrame.from_dict(data=table, orient='index', dtype='float')
-            b.sort_index(inplace=True)
-            self.txt_descriptors[desc_type] = b.to_sparse().fillna(0)
-            del(b) # - attempt at memory efficiency.
+                ids = [self.get_location_by_name(poi_name).name for poi_name in store.ids]
+            else:
+                ids = store.ids
+
+            self.txt_descriptors[desc_type] = store.reindex(ids)
         
         print("User Descriptions Loaded...")
     
@@ -77,67 +73,96 @@ class Database():
     ##
     # Stores visual descriptors data.
     #
-    # locationid is the id of the location that is being loaded into the database.
-    # model in ['CM', 'CM3x3', 'CN', 'CN3x3', 'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
-    # csv file to load.
-    # 
-    # Each keypair maps to a dataframe with structure:
-    #   <'photoid', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9'>
-    def add_visual_descriptors(self, files):
+    # files are the csv files to load, named '<location title> <model>.csv', with
+    #   model in ['CM', 'CM3x3', 'CN', 'CN3x3', 'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
+    #
+    # The files are parsed in parallel by a pool of processes (one per cpu if processes
+    #   is None) and assembled straight into the feature store, without building a
+    #   table per location and model.
+    def add_visual_descriptors(self, files, processes=None):
         def get_info_from_file(file):
             name = split(file)[1]
             return name.split(' ')
 
+        keys = []
         for file in files:
             filename = Database.get_file_name(file)
             loc_title, model = get_info_from_file(filename)
             location = self.get_location_by_title(loc_title)
-            locationid = int(location.name)
-            # get number of columns in CSV file.
-            with open(file, 'r') as f:
-                readr = reader(f)
-                ncol=len(next(readr))
-            # load into dataframe.
-            col_names = [model + '_' + str(i) for i in range(ncol-1)]
-            table = pd.read_csv(file, index_col=0, header=None, names=col_names, dtype='float')
-            self.vis_descriptors[locationid, model] = table.sort_index().to_sparse().fillna(0)
-        
+            keys.append((int(location.name), model))
+
+        if processes == 1:
+            parsed = [Database.read_vis_file(file) for file in files]
+        else:
+            with Pool(processes) as p:
+                parsed = p.map(Database.read_vis_file, files)
+
         # NOTE: This is added in phase III for efficiency purposes. Limits functionality for speed.
-        self.simplify_db()
+        self.simplify_db(blocks=dict(zip(keys, parsed)))
 
         print("Visual Descriptors Loaded...")
 
 
-    
+    @staticmethod
+    def read_vis_file(file):
+        """
+        Parses one visual descriptor csv in a single pass. The number of columns is taken from
+            the same read rather than opening the file again.
+        :param path file: csv with the image id followed by the descriptor values on each row.
+        :return tuple (ids, values): int64 image ids and the (rows x columns) float32 descriptors.
+        """
+        table = pd.read_csv(file, header=None, index_col=0)
+        return np.asarray(table.index, dtype=np.int64), np.ascontiguousarray(table.values, dtype=np.float32)
+
+
     def load_vis(self, subdir='saved'):
         """
+        Memory maps the feature store saved by simplify_db. A combined table pickled by earlier
+        versions (visdata.pickle) is converted to the binary format first.
+        :return bool: if saved visual data was found.
+        """
+        legacy = abspath(join(subdir, 'visdata.pickle'))
+        if not FeatureStore.exists(subdir):
+            if not isfile(legacy):
+                return False
+            FeatureStore.from_frame(pd.read_pickle(legacy)).save(subdir)
+        self.set_features(FeatureStore.open(subdir))
+
+        self.vis_descriptors = None
+        with open(abspath(join(subdir, 'loc.pickle')), 'rb') as f:
+            self.loc_map = pickle.load(f)
+        print('Visual Descriptors Loaded...')
+        return True
+
+
+    def set_features(self, features):
         """
-        path = abspath(join(subdir, 'visdata.pickle'))
-        if isfile(path):
-            self.vis_descriptors = None
-            self.vis = pd.read_pickle(path)
-            with open(abspath(join(subdir, 'loc.pickle')), 'rb') as f:
-                self.loc_map = pickle.load(f)
-            print('Visual Descriptors Loaded...')
-            return True
-        return False
-
-
-    def simplify_db(self, subdir='saved'):
+        Makes a feature store the source of every visual table.
+        :param FeatureStore features:
+        """
+        self.features = features
+        self.vis = features.frame()
+        self.__locs__ = None
+
+
+    def simplify_db(self, subdir='saved', blocks=None):
         """
         Used in phase III to put data into a reduced state that is faster, since we don't need all the
         visual data separated by location.
+        :param dict blocks: parsed (ids, values) for each (locationid, model). Taken from the
+            per location tables if None.
         """
-        arbitrary_model = 'CM'
-        for location in self.locations.index:
-            for photo in self.vis_descriptors[location, arbitrary_model].index:
+        if blocks is None:
+            blocks = {key: (np.asarray(table.index, dtype=np.int64), table.values)
+                      for key, table in self.vis_descriptors.items()}
+
+        for (location, _), (ids, _) in blocks.items():
+            for photo in ids:
                 self.loc_map[int(photo)] = location
-                #self.loc_map[location] = list([int(a) for a in self.vis_descriptors[location,arbitrary_model].index])
 
-        # Set as combined table.        
-        self.vis = self.get_vis_table()
-        file_loc = abspath(join(subdir, 'visdata.pickle'))
-        self.vis.to_pickle(file_loc)
+        # Set as combined matrix, then use the memory mapped copy so it isn't held twice.
+        FeatureStore.from_blocks(blocks, self.vis_models).save(subdir)
+        self.set_features(FeatureStore.open(subdir))
         with open(abspath(join(subdir, 'loc.pickle')), 'wb+') as f:
             pickle.dump(self.loc_map, f)
         del(self.vis_descriptors)
@@ -230,9 +255,18 @@ class Database():
         return returnval
 
     # txt descriptors #####################################
-    def get_txt_desc_table(self, atype):
+    def get_txt_store(self, atype):
+        """
+        :param str atype: term space (photo, user, poi).
+        :return TermStore: CSR matrix of the term space.
+        """
+        if not atype in self.txt_descriptors:
+            raise ValueError('Textual descriptors are not loaded for: %s' % atype)
         return self.txt_descriptors[atype]
 
+    def get_txt_desc_table(self, atype):
+        return self.get_txt_store(atype).frame()
+
 
     def get_txt_vector(self, atype, an_id):
          """
@@ -245,13 +279,31 @@ class Database():
     # vis descriptors #####################################
 
 
-    # def get_vis_table(self):
-    #    return self.vis
+    def get_features(self):
+        """
+        :return FeatureStore: every visual descriptor as one float32 matrix.
+        """
+        if self.features is None:
+            raise ValueError('Visual descriptors must be loaded to get the feature store.')
+        return self.features
+
+
+    def __location_rows__(self, locationid):
+        """
+        Rows of the feature store holding the images of a location.
+        """
+        if self.__locs__ is None:
+            self.__locs__ = np.array([self.loc_map.get(int(image), -1) for image in self.features.ids])
+        return np.flatnonzero(self.__locs__ == locationid)
+
 
     def get_vis_table(self, locationid=None, model=None):
-        # for Phase III only - speeds things up.
-        if not self.vis is None:
-            return self.vis
+        # for Phase III only - tables are views of the feature store.
+        if not self.features is None:
+            if locationid is None and model is None:
+                return self.vis
+            rows = None if locationid is None else self.__location_rows__(locationid)
+            return self.features.frame(model=model, rows=rows)
 
         # If given both a location and a model, get the table.
         if locationid and model:
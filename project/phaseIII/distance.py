@@ -1,6 +1,7 @@
 #! /bin/usr/python3.6
 
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
 from util import timed
@@ -70,6 +71,92 @@ class Similarity():
 
         return pd.DataFrame(data=similarity, index=index1, columns=index2)
     
+    @staticmethod
+    def top_k(similarity, k, exclude_self=True):
+        """
+        Finds the k largest entries of every row of a similarity block in one batched pass. Uses
+        argpartition so each row costs O(n) rather than a full sort, then orders only the k survivors.
+        :param numpy.ndarray similarity: (rows x columns) similarity block.
+        :param int k: number of entries to keep from each row.
+        :param bool exclude_self: ignore the diagonal so a row is never its own neighbor.
+        :return tuple (indices, weights): (rows x k) arrays of column indices and their similarities,
+            each row sorted by descending similarity.
+        """
+        similarity = np.asarray(similarity)
+        rows, cols = similarity.shape
+        k = min(k, cols - 1 if exclude_self else cols)
+        if k <= 0:
+            return np.empty((rows, 0), dtype=np.intp), np.empty((rows, 0), dtype=similarity.dtype)
+
+        if exclude_self:
+            similarity = similarity.copy()
+            diag = np.arange(min(rows, cols))
+            similarity[diag, diag] = -np.inf
+
+        # argpartition leaves the k largest in the last k columns, in no particular order.
+        indices = np.argpartition(similarity, cols - k, axis=1)[:, cols - k:]
+        weights = np.take_along_axis(similarity, indices, axis=1)
+        # sort just the k survivors of each row, largest first.
+        order = np.argsort(-weights, axis=1, kind='stable')
+        indices = np.take_along_axis(indices, order, axis=1)
+        weights = np.take_along_axis(weights, order, axis=1)
+        return indices, weights
+
+
+    @staticmethod
+    @timed
+    def cosine_top_k(table, k, block=1024, dtype=np.float32):
+        """
+        Streaming all-pairs cosine similarity which keeps only the running top k of each row. The
+            similarity is computed one (block x block) tile at a time, so peak memory is
+            O(n*k + block^2) instead of the O(n^2) of cosine_similarity.
+        :param Pandas.Dataframe table: objects as rows, features as columns. May also be an ndarray.
+        :param int k: number of neighbors to keep for each row.
+        :param int block: number of rows and columns per tile.
+        :param numpy.dtype dtype: precision to compute the similarities in.
+        :return TopKSimilarity: nearest neighbors of each row, excluding the row itself.
+        """
+        if isinstance(table, pd.DataFrame):
+            ids = list(table.index)
+            matrix = np.array(table.values, dtype=dtype)
+        else:
+            matrix = np.array(table, dtype=dtype)
+            ids = list(range(matrix.shape[0]))
+
+        # normalize once so every tile is a plain matrix product.
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1
+        matrix /= norms[:, np.newaxis]
+
+        n = matrix.shape[0]
+        k = max(0, min(k, n - 1))
+        indices = np.empty((n, k), dtype=np.intp)
+        weights = np.empty((n, k), dtype=dtype)
+
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            best_idx = np.empty((stop - start, 0), dtype=np.intp)
+            best_w = np.empty((stop - start, 0), dtype=dtype)
+
+            for cstart in range(0, n, block):
+                cstop = min(cstart + block, n)
+                tile = matrix[start:stop].dot(matrix[cstart:cstop].T)
+                # remove self similarity where the tile crosses the diagonal.
+                diag = np.arange(max(start, cstart), min(stop, cstop))
+                tile[diag - start, diag - cstart] = -np.inf
+
+                # merge the tile into the running top k of each row.
+                cand_w = np.hstack([best_w, tile])
+                cand_idx = np.hstack([best_idx, np.broadcast_to(np.arange(cstart, cstop), tile.shape)])
+                top, best_w = Similarity.top_k(cand_w, k, exclude_self=False)
+                best_idx = np.take_along_axis(cand_idx, top, axis=1)
+
+            indices[start:stop] = best_idx
+            weights[start:stop] = best_w
+
+        return TopKSimilarity(ids, indices, weights)
+
+
     # finds similarity between two vectors (numpy arrays)
     @staticmethod
     def cos_similarity(vector1, vector2):
@@ -81,18 +168,96 @@ class Similarity():
         return similarity
 
 
+class TopKSimilarity():
+    """
+    The k most similar neighbors of every object, as produced by Similarity.cosine_top_k. Rows of
+        indices and weights are sorted by descending similarity.
+    """
+
+    def __init__(self, ids, indices, weights):
+        """
+        :param list ids: object ids, in row order.
+        :param numpy.ndarray indices: (n x k) row positions of each object's neighbors.
+        :param numpy.ndarray weights: (n x k) similarity to each of those neighbors.
+        """
+        self.ids = ids
+        self.indices = indices
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    def prefix(self, k):
+        """
+        Restricts every neighbor list to its k most similar entries. Since rows are sorted, this is
+            a zero-copy view of the stored arrays rather than a new top k computation.
+        :param int k: number of neighbors to keep. Must not exceed self.k.
+        :return TopKSimilarity: view sharing memory with this object.
+        """
+        if k > self.k:
+            raise ValueError('Cannot take %s neighbors from a list of %s.' % (k, self.k))
+        return TopKSimilarity(self.ids, self.indices[:, :k], self.weights[:, :k])
+
+    def edges(self):
+        """
+        Flattens the neighbor lists into directed edges.
+        :return tuple (src, dst, weight): flat arrays, k entries per object.
+        """
+        src = np.repeat(np.arange(len(self.ids)), self.k)
+        return src, self.indices.ravel(), self.weights.ravel()
+
+
 class Scoring():
 
+    METHODS = ['greedy', 'hungarian']
+
     @staticmethod
-    def score_matrix(sim_matrix):
-        similarity = 0
+    def score_matrix(sim_matrix, method='greedy'):
+        """
+        Scores how well the rows of a similarity matrix match its columns (see below).
+        :param numpy.ndarray sim_matrix: (m x n) similarity matrix.
+        :param str method: 'greedy' (repeatedly take the largest remaining value) or 'hungarian'
+            (the one to one matching with the largest total).
+        :return float: matched similarity over the average of m and n.
+        """
+        sim_matrix = np.asarray(sim_matrix)
         denominator = sum(sim_matrix.shape) / 2
-        for i in range(min(sim_matrix.shape)):
-            x, y = np.where(sim_matrix == np.max(sim_matrix))[0][0], np.where(sim_matrix == np.max(sim_matrix))[1][0]
-            similarity += sim_matrix[x, y]
-            sim_matrix = np.delete(sim_matrix, (x), axis=0)
-            sim_matrix = np.delete(sim_matrix, (y), axis=1)
-        return similarity / denominator
+        if method == 'greedy':
+            rows, cols = Scoring.greedy(sim_matrix)
+        elif method == 'hungarian':
+            rows, cols = linear_sum_assignment(-sim_matrix)
+        else:
+            raise ValueError('Invalid scoring method specified: %s' % method)
+        return sim_matrix[rows, cols].sum() / denominator
+
+    @staticmethod
+    def greedy(sim_matrix):
+        """
+        Greedy matching: the largest value whose row and column are both unused is taken until the
+        rows or columns run out. Values are visited once in descending order (ties in row major
+        order, as the first np.where match was), with masks marking the used rows and columns in
+        place of deleting them from the matrix.
+        :param numpy.ndarray sim_matrix: (m x n) similarity matrix.
+        :return tuple (rows, cols): positions of the matched values.
+        """
+        m, n = sim_matrix.shape
+        order = np.argsort(-sim_matrix, axis=None, kind='stable')
+        used_rows = np.zeros(m, dtype=bool)
+        used_cols = np.zeros(n, dtype=bool)
+        rows, cols = [], []
+        for x, y in zip(*np.divmod(order, n)):
+            if used_rows[x] or used_cols[y]:
+                continue
+            used_rows[x] = used_cols[y] = True
+            rows.append(x)
+            cols.append(y)
+            if len(rows) == min(m, n):
+                break
+        return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
 
     # Explanation of the above algorithm to find a similarity score for a similarity matrix:
     # Sum of max. vals is equal to 0.
@@ -0,0 +1,322 @@
+#! /bin/usr/python3.6
+
+import numpy as np
+import pandas as pd
+import json
+from scipy.sparse import csr_matrix, csc_matrix
+from os.path import isfile, join, abspath
+from collections import OrderedDict
+
+
+class FeatureStore():
+    """
+    Every visual descriptor held as one C-contiguous float32 matrix, one row per image and one
+    contiguous range of columns per visual model. Consumers read views of the matrix (a model's
+    columns, or a row) instead of copies of sparse pandas tables.
+
+    On disk a store is three files: the raw float32 matrix (features.bin), the image ids
+    (features_ids.npy) and a json header with the shape and model column ranges (features.json).
+    Opened stores are memory mapped, so loading is near instant and every process reading the
+    same files shares their pages.
+    """
+
+    MATRIX = 'features.bin'
+    IDS = 'features_ids.npy'
+    HEADER = 'features.json'
+
+    def __init__(self, matrix, ids, models):
+        """
+        :param numpy.ndarray matrix: (n x d) descriptors, one row per image.
+        :param list ids: image id of each row.
+        :param dict models: maps each model to its (start, stop) column range, in column order.
+        """
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.models = OrderedDict(models)
+        if self.matrix.shape[0] != len(self.ids):
+            raise ValueError('Feature matrix has %s rows but %s ids.' % (self.matrix.shape[0], len(self.ids)))
+        self.__rows__ = {int(image): row for row, image in enumerate(self.ids)}
+        self.location = None # directory of the files when memory mapped.
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+
+    def row(self, image):
+        """
+        :param int image: image id.
+        :return int: row of the image in the matrix.
+        """
+        image = int(image)
+        if not image in self.__rows__:
+            raise ValueError('Image is not in the feature store: %s' % image)
+        return self.__rows__[image]
+
+
+    def rows(self, images):
+        """
+        :param list images: image ids.
+        :return numpy.ndarray: row of each image in the matrix.
+        """
+        return np.array([self.row(image) for image in images], dtype=np.intp)
+
+
+    def columns(self, model=None):
+        """
+        Column range of a model, or of every model if None.
+        :param str model: visual model.
+        :return slice:
+        """
+        if model is None:
+            return slice(0, self.matrix.shape[1])
+        if not model in self.models:
+            raise ValueError('Invalid visual model specified: %s' % model)
+        return slice(*self.models[model])
+
+
+    def column_names(self, model=None):
+        """
+        Names of the columns of a model (or every model), as <model>_<i>.
+        """
+        models = self.models.items() if model is None else [(model, self.models[model])]
+        return [m + '_' + str(i) for m, (start, stop) in models for i in range(stop - start)]
+
+
+    def view(self, model=None, rows=None):
+        """
+        The descriptors of a model for some rows. Selecting a model is a zero-copy view, selecting
+            rows by an index array gathers a copy of just those rows.
+        :param str model: visual model. Every model if None.
+        :param numpy.ndarray rows: rows to select. Every row if None.
+        :return numpy.ndarray:
+        """
+        matrix = self.matrix[:, self.columns(model)]
+        return matrix if rows is None else matrix[rows]
+
+
+    def vector(self, image, model=None):
+        """
+        :param int image: image id.
+        :param str model: visual model. Every model if None.
+        :return numpy.ndarray: view of the image's descriptor.
+        """
+        return self.matrix[self.row(image), self.columns(model)]
+
+
+    def frame(self, model=None, rows=None):
+        """
+        The descriptors wrapped as a DataFrame indexed by image id. Without rows, the frame shares
+            memory with the matrix.
+        :param str model: visual model. Every model if None.
+        :param numpy.ndarray rows: rows to select. Every row if None.
+        :return DataFrame:
+        """
+        ids = self.ids if rows is None else self.ids[rows]
+        return pd.DataFrame(self.view(model, rows), index=ids, columns=self.column_names(model), copy=False)
+
+
+    def __getstate__(self):
+        # a memory mapped store is pickled as its location so worker processes map the same
+        #   pages instead of receiving a copy of the matrix.
+        if not self.location is None:
+            return {'location': self.location}
+        return self.__dict__
+
+
+    def __setstate__(self, state):
+        if 'matrix' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(FeatureStore.open(state['location']).__dict__)
+
+
+    def save(self, subdir):
+        """
+        Writes the store to its binary on disk format.
+        :param path subdir: directory to write the three files to.
+        """
+        self.matrix.tofile(abspath(join(subdir, FeatureStore.MATRIX)))
+        np.save(abspath(join(subdir, FeatureStore.IDS)), self.ids)
+        header = {'shape': list(self.matrix.shape), 'dtype': str(self.matrix.dtype),
+                  'models': [[model, start, stop] for model, (start, stop) in self.models.items()]}
+        with open(abspath(join(subdir, FeatureStore.HEADER)), 'w+') as f:
+            json.dump(header, f)
+
+
+    @staticmethod
+    def exists(subdir):
+        """
+        :return bool: if a store has been saved to the directory.
+        """
+        return all(isfile(abspath(join(subdir, name))) for name in
+                   (FeatureStore.MATRIX, FeatureStore.IDS, FeatureStore.HEADER))
+
+
+    @staticmethod
+    def open(subdir):
+        """
+        Memory maps a store saved by FeatureStore.save. The matrix is read only.
+        :param path subdir: directory holding the three files.
+        :return FeatureStore:
+        """
+        if not FeatureStore.exists(subdir):
+            raise FileNotFoundError('No feature store saved in: %s' % subdir)
+        with open(abspath(join(subdir, FeatureStore.HEADER)), 'r') as f:
+            header = json.load(f)
+        shape = tuple(header['shape'])
+        matrix = np.memmap(abspath(join(subdir, FeatureStore.MATRIX)), dtype=header['dtype'], mode='r', shape=shape)
+        ids = np.load(abspath(join(subdir, FeatureStore.IDS)))
+        if len(ids) != shape[0]:
+            raise ValueError('Feature store in %s has %s rows but %s ids.' % (subdir, shape[0], len(ids)))
+
+        store = FeatureStore(matrix, ids, [(model, (start, stop)) for model, start, stop in header['models']])
+        store.location = abspath(subdir)
+        return store
+
+
+    @staticmethod
+    def from_blocks(blocks, models):
+        """
+        Assembles parsed descriptor blocks into one store. The matrix is allocated once and every
+            block is copied straight into its rows and model columns. Rows are sorted by image id,
+            missing descriptors are zero.
+        :param dict blocks: maps (locationid, model) to an (ids, values) pair of arrays.
+        :param list models: visual models, in the column order to store them.
+        :return FeatureStore:
+        """
+        ids = np.unique(np.concatenate([np.asarray(block_ids, dtype=np.int64) for block_ids, _ in blocks.values()]))
+        widths = {model: 0 for model in models}
+        for (_, model), (_, values) in blocks.items():
+            widths[model] = max(widths[model], values.shape[1])
+
+        ranges = OrderedDict()
+        start = 0
+        for model in models:
+            ranges[model] = (start, start + widths[model])
+            start += widths[model]
+
+        matrix = np.zeros((len(ids), start), dtype=np.float32)
+        for (_, model), (block_ids, values) in blocks.items():
+            rows = np.searchsorted(ids, np.asarray(block_ids, dtype=np.int64))
+            first = ranges[model][0]
+            matrix[rows, first:first + values.shape[1]] = values
+
+        return FeatureStore(matrix, ids, ranges)
+
+
+    @staticmethod
+    def from_frame(table):
+        """
+        Converts a combined visual table with <model>_<i> columns (as pickled by earlier versions)
+            into a store.
+        :param DataFrame table:
+        :return FeatureStore:
+        """
+        models = OrderedDict()
+        for column in table.columns:
+            models.setdefault(str(column).rsplit('_', 1)[0], []).append(column)
+        order = [column for columns in models.values() for column in columns]
+
+        ranges = OrderedDict()
+        start = 0
+        for model, columns in models.items():
+            ranges[model] = (start, start + len(columns))
+            start += len(columns)
+
+        matrix = np.asarray(table[order].values, dtype=np.float32)
+        return FeatureStore(matrix, np.asarray(table.index, dtype=np.int64), ranges)
+
+
+
+class TermStore():
+    """
+    Textual descriptors of one term space (photo, user or poi) as a scipy CSR matrix, one row per
+    object and one column per interned term. Only the nonzero values are ever stored.
+    """
+
+    def __init__(self, matrix, ids, terms):
+        """
+        :param scipy.sparse.csr_matrix matrix: (objects x terms) descriptor values.
+        :param list ids: id of each row.
+        :param list terms: term of each column.
+        """
+        self.matrix = csr_matrix(matrix, dtype=np.float32)
+        self.ids = list(ids)
+        self.terms = list(terms)
+        if self.matrix.shape != (len(self.ids), len(self.terms)):
+            raise ValueError('Term matrix has shape %s but %s ids and %s terms.' %
+                             (self.matrix.shape, len(self.ids), len(self.terms)))
+        self.__rows__ = {an_id: row for row, an_id in enumerate(self.ids)}
+        self.__postings__ = None
+        self.__norms__ = None
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+
+    def row(self, an_id):
+        """
+        :param an_id: object id.
+        :return int: row of the object in the matrix.
+        """
+        if not an_id in self.__rows__:
+            raise ValueError('Object is not in the term store: %s' % an_id)
+        return self.__rows__[an_id]
+
+
+    def vector(self, an_id):
+        """
+        :param an_id: object id.
+        :return csr_matrix: (1 x terms) descriptor of the object.
+        """
+        return self.matrix[self.row(an_id)]
+
+
+    def postings(self):
+        """
+        Posting lists of every term: the matrix in CSC form, so column t holds the rows (and
+            values) of the objects containing term t. Built on first use.
+        :return csc_matrix:
+        """
+        if self.__postings__ is None:
+            self.__postings__ = csc_matrix(self.matrix)
+        return self.__postings__
+
+
+    def norms(self):
+        """
+        :return numpy.ndarray: euclidean norm of every row, computed on first use.
+        """
+        if self.__norms__ is None:
+            self.__norms__ = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1), dtype=np.float64).ravel())
+        return self.__norms__
+
+
+    def reindex(self, ids):
+        """
+        Relabels the rows and sorts them by their new ids.
+        :param list ids: new id of each row, in the current row order.
+        :return TermStore:
+        """
+        order = sorted(range(len(ids)), key=lambda row: ids[row])
+        return TermStore(self.matrix[order], [ids[row] for row in order], self.terms)
+
+
+    def frame(self):
+        """
+        The descriptors as a sparse DataFrame indexed by object id, with terms as columns.
+        :return SparseDataFrame:
+        """
+        return pd.SparseDataFrame(self.matrix, index=self.ids, columns=self.terms, default_fill_value=0)
@@ -7,7 +7,9 @@ from functools import wraps
 import pickle
 from collections import defaultdict
 import pandas as pd
-from distance import Similarity
+import numpy as np
+from scipy.sparse import csr_matrix
+from distance import Similarity, TopKSimilarity
 from sys import stdout
 
 
@@ -49,6 +51,16 @@ class Graph():
         # data structor to store nodes in a given cluster for faster access.
         self.clusters = {}
 
+        # maps node name -> vertex index, so lookups don't scan the vertex sequence.
+        self.__index__ = {}
+        if 'name' in self.__graph__.vs.attributes():
+            self.__index__ = {name: i for i, name in enumerate(self.__graph__.vs['name'])}
+
+        # vertex index -> set of clusters it belongs to, for cluster restricted neighbor queries.
+        self.__members__ = defaultdict(set)
+        # CSR style out adjacency (indptr, indices, weights, names). Built on first use.
+        self.__csr__ = None
+
         if not similarity is None:
             self.add_similarity(similarity)
 
@@ -68,19 +80,14 @@ class Graph():
         if graph is None:
             graph = self.__graph__
 
-        # translate from name tuples to object tuples
-        edges = [(self.__get_node_by_name__(e1), self.__get_node_by_name__(e2)) for e1, e2 in edges]
-
-        # get base list based on if list exists or not. Probably a cleaner way to do this.
-        num_edges = len(graph.es)
-        if num_edges == 0:
-            temp_weights = list()
-        else:
-            temp_weights = graph.es[Graph.SIM]
-        temp_weights.extend(weights)
+        # translate from name tuples to vertex index tuples
+        edges = [(self.__vertex_index__(e1, graph), self.__vertex_index__(e2, graph)) for e1, e2 in edges]
 
+        # only the new edges get their weight set, the existing weights are left alone.
+        start = graph.ecount()
         graph.add_edges(edges)
-        graph.es[Graph.SIM] = temp_weights
+        graph.es[start:][Graph.SIM] = list(weights)
+        self.__csr__ = None
         return
 
 
@@ -94,11 +101,13 @@ class Graph():
         if graph is None:
             graph = self.__graph__
 
-        start = self.__get_node_by_name__(start_node)
-        end = self.__get_node_by_name__(end_node)
+        start = self.__vertex_index__(start_node, graph)
+        end = self.__vertex_index__(end_node, graph)
 
-        edges = graph.es.find(_source=start.index, _target=end.index)
-        return edges
+        eid = graph.get_eid(start, end, error=False)
+        if eid < 0:
+            return None
+        return graph.es[eid]
     
 
     def __add_label__(self, node, label, value, graph=None):
@@ -124,10 +133,43 @@ class Graph():
         """
         if graph is None:
             graph = self.__graph__
+        return graph.vs[self.__vertex_index__(name, graph)]
+
+
+    def __vertex_index__(self, name, graph=None):
+        """
+        retrieve the vertex index of a node by its name. O(1) for the main graph.
+        :param obj name: identifier for this node.
+        """
+        if graph is None or graph is self.__graph__:
+            if not name in self.__index__:
+                raise ValueError('The node name provided couldn\'t be found: %s' % name)
+            return self.__index__[name]
+
         node = graph.vs.select(name=name) 
         if len(node) != 1:
             raise ValueError('The node name provided couldn\'t be found or is repeated: %s' % name)
-        return node[0]
+        return node[0].index
+
+
+    def __adjacency__(self):
+        """
+        Get the CSR style out adjacency of the main graph, building it if the edges have changed.
+            Row i of the adjacency is indices[indptr[i]:indptr[i+1]], with the matching weights.
+        :return tuple (indptr, indices, weights, names):
+        """
+        if self.__csr__ is None:
+            graph = self.__graph__
+            n = graph.vcount()
+            edges = np.array(graph.get_edgelist(), dtype=np.intp).reshape(-1, 2)
+            weights = np.array(graph.es[Graph.SIM] if graph.ecount() else [], dtype=float)
+
+            order = np.argsort(edges[:, 0], kind='stable')
+            indptr = np.zeros(n + 1, dtype=np.intp)
+            np.cumsum(np.bincount(edges[:, 0], minlength=n), out=indptr[1:])
+            names = graph.vs['name'] if n else []
+            self.__csr__ = (indptr, edges[order, 1], weights[order], names)
+        return self.__csr__
 
 
     ###########################################################################################
@@ -156,8 +198,17 @@ class Graph():
         if not isinstance(vertices, list):
             raise ValueError('Vertices parameters should be a list of names.')
 
-        for vertex in vertices:
-            self.__graph__.add_vertex(name=vertex, cluster=None)
+        graph = self.__graph__
+        start = graph.vcount()
+        for i, vertex in enumerate(vertices):
+            if vertex in self.__index__:
+                raise ValueError('The node name provided is repeated: %s' % vertex)
+            self.__index__[vertex] = start + i
+
+        graph.add_vertices(len(vertices))
+        graph.vs[start:]['name'] = vertices
+        graph.vs[start:][Graph.CLUSTER] = [None] * len(vertices)
+        self.__csr__ = None
 
 
     @timed 
@@ -165,20 +216,23 @@ class Graph():
         """
         Adds similarity matrix information to database. Adds all ~8900 photos and the weighted edges
         to their k most similar partners.
-        :param Pandas.Dataframe similarity: photo-photo similarity matrix
+        :param Pandas.Dataframe similarity: photo-photo similarity matrix, or the TopKSimilarity
+            from Similarity.cosine_top_k.
         """
+        if isinstance(similarity, TopKSimilarity):
+            src, dst, weights = similarity.edges()
+            self.add_edge_arrays(similarity.ids, src, dst, weights)
+            return
+
         assert(all(similarity.index == similarity.columns))
         # TODO photo too large for C int, breaks igraph lib.
-        photos = list(similarity.index)
-        self.add_vertices(photos)
-        # get the nearest neighbors similarity wise to each image and add to database.
-        for i, photo in enumerate(photos):
-            print(str(i))
-            photo = int(photo)
-            row = similarity.loc[photo].sort_values(ascending=False)
-            edges = [(photo, int(other)) for other in row.index]
-            weights = [other for other in row]
-            self.__add_edges__(edges, weights)
+        photos = [int(photo) for photo in similarity.index]
+        # every pair becomes an edge, each row ordered most similar first.
+        values = np.asarray(similarity.values)
+        dst = np.argsort(-values, axis=1, kind='stable')
+        weights = np.take_along_axis(values, dst, axis=1)
+        src = np.repeat(np.arange(len(photos)), len(photos))
+        self.add_edge_arrays(photos, src, dst.ravel(), weights.ravel())
         return
     
 
@@ -199,8 +253,49 @@ class Graph():
         self.__add_edges__(edges, weights)
         return
 
+
+    @timed
+    def add_edge_arrays(self, names, src, dst, weights):
+        """
+        Adds vertices and edges from the compact arrays produced by TopKSimilarity.edges. Edge
+            endpoints are positions in names, so no per-edge name lookups are needed.
+        :param list names: vertex names, in the order src and dst index them.
+        :param numpy.ndarray src: integer positions of edge sources.
+        :param numpy.ndarray dst: integer positions of edge targets.
+        :param numpy.ndarray weights: weight of each edge.
+        """
+        graph = self.__graph__
+        offset = graph.vcount()
+        self.add_vertices(list(names))
+
+        start = graph.ecount()
+        graph.add_edges(list(zip((src + offset).tolist(), (dst + offset).tolist())))
+        graph.es[start:][Graph.SIM] = np.asarray(weights, dtype=float).tolist()
+        self.__csr__ = None
+        return
+
     
 
+    @staticmethod
+    def from_arrays(names, src, dst, weights):
+        """
+        Bulk constructor. Creates the whole igraph in one call from integer index arrays, setting
+            the names and weights once rather than resolving each edge by name.
+        :param list names: vertex names, in the order src and dst index them.
+        :param numpy.ndarray src: integer positions of edge sources.
+        :param numpy.ndarray dst: integer positions of edge targets.
+        :param numpy.ndarray weights: weight of each edge.
+        :return Graph:
+        """
+        names = list(names)
+        edges = list(zip(np.asarray(src).tolist(), np.asarray(dst).tolist()))
+        g = igraph.Graph(n=len(names), edges=edges, directed=True)
+        g.vs['name'] = names
+        g.vs[Graph.CLUSTER] = [None] * len(names)
+        g.es[Graph.SIM] = np.asarray(weights, dtype=float).tolist()
+        return Graph(graph=g)
+
+
     def get_images(self):
         return self.__graph__.vs()['name']
 
@@ -220,9 +315,14 @@ class Graph():
         ;param obj src: Name of start node, or tail.
         :param obj end: Name of end node, or head.
         """
-        e = self.__find_edge__(src, end)
-        if e:
-            return Edge(src, end, e[Graph.SIM])
+        indptr, indices, weights, _ = self.__adjacency__()
+        i = self.__vertex_index__(src)
+        j = self.__vertex_index__(end)
+        # scan only the out edges of src.
+        row = indices[indptr[i]:indptr[i + 1]]
+        hits = np.flatnonzero(row == j)
+        if len(hits):
+            return Edge(src, end, weights[indptr[i] + hits[0]])
         # if edge doesn't exist.
         return None
 
@@ -252,21 +352,18 @@ class Graph():
         :param list clusters: iterable of clusters to search for neighbors in.
         :return list edges: returns list of edges to neighboring nodes, indicating the similarity.
         """
-        n = self.__get_node_by_name__(node)
-        neighbors = n.neighbors(mode='OUT')
+        indptr, indices, weights, names = self.__adjacency__()
+        i = self.__vertex_index__(node)
+        start, stop = indptr[i], indptr[i + 1]
+        neighbors = range(start, stop)
 
         # if a set of clusters were specified, then limit neighbors to only those in the clusters.
         if clusters:
-            temp = []
-            for cluster in clusters:
-                vertices = self.clusters[cluster]
-                intersection = [i for i in neighbors if i in vertices]
-                temp.extend(intersection)
-                [neighbors.remove(i) for i in intersection] # for efficiency
-            neighbors = temp
+            clusters = set(clusters)
+            neighbors = [e for e in neighbors if self.__members__[indices[e]] & clusters]
         
         # turn into Edge interface object.
-        return_val = [self.edge(node, neighbor['name']) for neighbor in neighbors]
+        return_val = [Edge(node, names[indices[e]], weights[e]) for e in neighbors]
         
         return return_val
 
@@ -289,6 +386,7 @@ class Graph():
         if not cluster in self.clusters:
             self.clusters[cluster] = list()
         self.clusters[cluster].append(node)
+        self.__members__[self.__vertex_index__(node)].add(cluster)
         # add to graph.
         self.__add_label__(node, Graph.CLUSTER, cluster)
     
@@ -309,10 +407,13 @@ class Graph():
             return
 
         self.clusters[cluster].remove(node)
+        members = self.__members__[self.__vertex_index__(node)]
+        if not node in self.clusters[cluster]:
+            members.discard(cluster)
         # see if this has any alternative labels in the clusters dictionary.
         c = None
-        for cluster, l in self.clusters.items():
-            if node in l:
+        for cluster in self.clusters:
+            if cluster in members:
                 c = cluster
                 break
         self.__add_label__(node, Graph.CLUSTER, c)
@@ -328,6 +429,7 @@ class Graph():
             graph = self.__graph__
 
         self.clusters = {}
+        self.__members__ = defaultdict(set)
         clusters = [None for v in graph.vs]
         self.__graph__.vs[Graph.CLUSTER] = clusters
     
@@ -350,6 +452,22 @@ class Graph():
 
     
 
+    def get_sparse_adjacency(self, weighted=False):
+        """
+        Exports the adjacency as a scipy.sparse CSR matrix, avoiding the dense n x n table built by
+            get_adjacency. Row i holds the out edges of the vertex ids[i].
+        :param bool weighted: use the edge similarity as the entries instead of 1.
+        :return tuple (csr_matrix, numpy.ndarray): adjacency and the index -> image id array.
+        """
+        indptr, indices, weights, names = self.__adjacency__()
+        n = len(indptr) - 1
+        data = weights if weighted else np.ones(len(indices))
+        adjacency = csr_matrix((data, indices, indptr), shape=(n, n))
+        adjacency.sum_duplicates()
+        return adjacency, np.array(names)
+
+
+
     def display(self, graph=None, clusters=[], filename='out.png', emphasis=[], emph_color=None, label=False):
         """
         Show representation of the graph. Saves to a png file so that the image can be viewed in
@@ -476,9 +594,52 @@ class Graph():
         graph = Graph(graph=g)
         with open(location + '_dict', 'rb') as f:
             graph.clusters = pickle.load(f)
+        for cluster, nodes in graph.clusters.items():
+            for node in nodes:
+                graph.__members__[graph.__vertex_index__(node)].add(cluster)
         return graph
 
 
+class GraphBuilder():
+    """
+    Builds the k nearest neighbor graphs for several values of k from one similarity pass. The
+        top max(k) neighbors are computed once and kept sorted, so the graph for any smaller k is
+        materialized from a prefix view of the same neighbor lists.
+    """
+
+    def __init__(self, neighbors):
+        """
+        :param TopKSimilarity neighbors: sorted neighbor lists for the largest k needed.
+        """
+        self.neighbors = neighbors
+        self.graphs = {}
+
+    @staticmethod
+    def from_table(table, max_k, block=1024):
+        """
+        Runs the single similarity pass over a feature table.
+        :param Pandas.Dataframe table: objects as rows, features as columns.
+        :param int max_k: largest k any graph will be requested for.
+        :param int block: tile size for Similarity.cosine_top_k.
+        """
+        return GraphBuilder(Similarity.cosine_top_k(table, max_k, block=block))
+
+    @property
+    def max_k(self):
+        return self.neighbors.k
+
+    def graph(self, k):
+        """
+        Get the k nearest neighbor graph, building it on first request.
+        :param int k: out degree of each vertex. Must not exceed max_k.
+        :return Graph:
+        """
+        if not k in self.graphs:
+            prefix = self.neighbors.prefix(k)
+            self.graphs[k] = Graph.from_arrays(prefix.ids, *prefix.edges())
+        return self.graphs[k]
+
+
 class GraphDriver():
     """
     Quick testing suite to validate the graph.
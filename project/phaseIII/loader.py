@@ -6,8 +6,10 @@ from os.path import isfile, isdir, join, abspath
 from util import timed
 from database import Database
 from multiprocessing import Pool
-from graph import Graph
-from distance import Similarity
+from graph import GraphBuilder
+from features import TermStore
+from scipy.sparse import coo_matrix
+from array import array
 import numpy as np
 
 ################################################################
@@ -133,49 +135,57 @@ class LocationReader(GenericReader): # GenericReader inheritance - don't forget
 #       file.
 #
 # Indended to be used by calling load_files. Returns dictionary with keys
-#   'photos', 'users', and 'poi'. Each key points to a pandas dataframe with
-#   the description information for those items.
+#   'photos', 'users', and 'poi'. Each key points to a TermStore with the
+#   description information for those items.
+#
+# Files are streamed a line at a time into (row, term, value) triples held in
+#   compact arrays, with every term interned to a column id on first sight, and
+#   the CSR matrix is built from the triples directly. Only one of tf, idf or
+#   tfidf is kept, chosen when the reader is created.
 class DescriptionReader(GenericReader):
 
-    def __init__(self):
+    VALUES = {'tf': 1, 'idf': 2, 'tfidf': 3}
+
+    def __init__(self, value='tfidf'):
+        if not value in DescriptionReader.VALUES:
+            raise ValueError('Invalid textual descriptor value specified: %s' % value)
         self.seen = []
+        self.value = value
 
     def load_file(self, file, index):
         if not isfile(file):
             raise OSError('Could not parse description file ' + str(file) + ' as it doesn\'t exist')
-        
-        # Strategy - create matrix representation with lists and then put into a new pandas dataframe.
-        table = {}
+
+        offset = DescriptionReader.VALUES[self.value]
+        ids = []
+        vocabulary = {}
+        rows, cols, data = array('i'), array('i'), array('f')
         with open(file) as f:
-            for i, line in enumerate(f):
-                # Tokenize
-                tokens = line.split(' ')
-                if '\n' in tokens:
-                    tokens.remove('\n')
-                # Find out how many tokens make up the ID
-                for k, token in enumerate(tokens):
-                    if '"' in token:
-                        # This is our first term. Return our index to get the id.
-                        j = k
-                        break
+            for line in f:
+                tokens = line.split()
+                if not tokens:
+                    continue
+                # Find out how many tokens make up the ID (the first term is quoted).
+                j = next((k for k, token in enumerate(tokens) if token.startswith('"')), len(tokens))
                 an_id = ' '.join(tokens[0: j])
                 # convert to an int if possible
                 try:
                     an_id = int(an_id)
-                except:
+                except ValueError:
                     pass
 
-                table[an_id] = {}
+                row = len(ids)
+                ids.append(an_id)
+                for k in range(j, len(tokens) - 3, 4):
+                    term = tokens[k].strip('"')
+                    rows.append(row)
+                    cols.append(vocabulary.setdefault(term, len(vocabulary)))
+                    data.append(float(tokens[k + offset]))
 
-                for k in range(j,len(tokens), 4):
-                    four_tuple = tokens[k : k + 4]
-                    term, tf, idf, tfidf = four_tuple
-                    term = term.replace('\"', '')
-                    # if 'User' in file and i == 784 and term[0] == 'x':
-                    #     print(four_tuple)
-                    table[an_id][term] = tfidf # At TAs Recommendation I chose one of these models arbitrarily.
-
-        return table
+        matrix = coo_matrix((np.frombuffer(data, dtype=np.float32),
+                             (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+                            shape=(len(ids), len(vocabulary))).tocsr()
+        return TermStore(matrix, ids, list(vocabulary))
 
 
 
@@ -201,7 +211,12 @@ class Loader():
 
     @staticmethod
     @timed
-    def make_database(folder, visdata='visdata.pickle'):
+    def make_database(folder, visdata='visdata.pickle', text=False, text_value='tfidf'):
+        """
+        :param path folder: dataset directory.
+        :param bool text: also load the textual descriptors.
+        :param str text_value: which textual value to load (tf, idf or tfidf).
+        """
 
         if not isdir(folder):
             raise TypeError('Loader requires a valid directory to load dataset from.')
@@ -215,12 +230,13 @@ class Loader():
         db.add_locations(location_dict)
         
         # Load text description data.
-        #text_files = [join(folder, 'desctxt', 'devset_textTermsPerPOI.txt'),
-                      #join(folder, 'desctxt', 'devset_textTermsPerImage.txt'),
-                      #join(folder, 'desctxt', 'devset_textTermsPerUser.txt')]
-        #types = ['poi', 'photo', 'user']
-        #descs = DescriptionReader().load_files(text_files,types)
-        #db.add_txt_descriptors(descs)
+        if text:
+            text_files = [join(folder, 'desctxt', 'devset_textTermsPerPOI.txt'),
+                          join(folder, 'desctxt', 'devset_textTermsPerImage.txt'),
+                          join(folder, 'desctxt', 'devset_textTermsPerUser.txt')]
+            types = ['poi', 'photo', 'user']
+            descs = DescriptionReader(text_value).load_files(text_files, types)
+            db.add_txt_descriptors(descs)
         
         # Load visual description data.
         if not(db.load_vis()):
@@ -233,46 +249,22 @@ class Loader():
 
     @staticmethod
     @timed
-    def make_graphs(db, k=None, all_ks=list(range(10)), path='.'):
+    def make_graphs(db, k=None, all_ks=list(range(10)), path='.', block=1024):
 
         if k == None:
             k = max(all_ks)
         else:
             all_ks = [k]
 
-        all_photos = db.get_vis_table()
-        similarity = Similarity.cosine_similarity(all_photos, all_photos)
-        assert(similarity.shape[0] == similarity.shape[1])
-        # set similarity diagonal to 0 so we don't have to deal with self similarity.
-        length = similarity.shape[0]
-        similarity.values[[np.arange(length)]*2]=0
-
-        # get similar k only.
-        edge_dict = {}
-        for i in range(length):
-            row = similarity.iloc[i]
-            edge_dict[row.name] = {}
-            sorted_row = row.sort_values(ascending=False)
-            keys = sorted_row.iloc[:k].index
-            for key in keys:
-                edge_dict[row.name][key] = sorted_row[key]
-        
-
-        all_ks.sort(reverse=True)
-        for nearest in all_ks:
+        all_ks = [nearest for nearest in all_ks if nearest > 0]
+        # one streamed similarity pass for the largest k; smaller graphs are prefixes of it.
+        builder = GraphBuilder.from_table(db.get_vis_table(), max(all_ks), block=block)
 
-            # get rid of smallest item.
+        for nearest in sorted(all_ks, reverse=True):
             print('Working on graph %s.' % nearest)
-            working = edge_dict.copy()
-            for key in working:
-                while len(working[key]) > k:
-                    min_key = min(working[key], key=working[key].get)
-                    working[key].pop(min_key)
-
+            g = builder.graph(nearest)
             print('\tSimilarity graph for %s created.' % nearest)
-            
-            g = Graph()
-            g.add_edge_dict(working)
+
             location = abspath(join(path, 'graph' + str(nearest)))
             g.display(filename=location+'.png')
             g.save(location=location)
@@ -1,19 +1,18 @@
 #! /bin/usr/python3.6 from loader import Loader
 from distance import Similarity
-from graph import Graph
+from graph import Graph, GraphBuilder
 from os.path import isdir, isfile, join, realpath
 from os import mkdir
 import argparse
 from util import timed, show_images, save_images, safe_mkdir, images_to_web
 import numpy as np
-import numpy.linalg as la
-import scipy.cluster.vq as vq
-from scipy.sparse import csc_matrix
 from collections import namedtuple, defaultdict
 from itertools import product
 from task5 import LSH
 from loader import Loader
 from task6 import KNN, PPR
+from pagerank import PageRank, PersonalizedPageRank
+from spectral import Spectral
 
 
 class Interface():
@@ -21,6 +20,9 @@ class Interface():
     def __init__(self, runall=False):
         self.__database__ = None
         self.__graph__ = None
+        self.__builder__ = None
+        self.__ppr__ = None
+        self.__lsh__ = LSH()
         self.__valid_types__ = ['photo', 'user', 'poi']
         self.__vis_models__ = ['CM', 'CM3x3', 'CN', 'CN3x3',
                                'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
@@ -51,9 +53,11 @@ class Interface():
         parser.add_argument('--imageId', type=int, metavar='imageId')
         parser.add_argument('--load', type=str, metavar='filepath')
         parser.add_argument('--graph', type=str, metavar='filename')
-        parser.add_argument('--layers', type=int, metavar='L')
-        parser.add_argument('--hashes', type=int, metavar='k')
+        parser.add_argument('--layers', type=int, nargs='+', metavar='L')
+        parser.add_argument('--hashes', type=int, nargs='+', metavar='k')
         parser.add_argument('--bins', type=int, metavar='b')
+        parser.add_argument('--probes', type=int, metavar='p')
+        parser.add_argument('--candidates', type=int, metavar='c')
         parser.add_argument('--file', type=str, metavar='filepath')
         # parser.add_argument('--cluster', type=int, metavar='c')
         parser.add_argument('--vectors', type=str)  # Assuming this is a file locaiton
@@ -131,6 +135,7 @@ class Interface():
             return
 
         self.__database__ = Loader.make_database(folder)
+        self.__builder__ = None
         print("Database loaded successfully.")
 
 
@@ -152,6 +157,29 @@ class Interface():
         print('Graph loaded successfully.')
 
 
+    def __graphs__(self, max_k):
+        """
+        Gets a GraphBuilder for the loaded database. All graphs up to max_k come from a single
+        similarity pass, which is kept while the database stays loaded.
+        :param int max_k: largest graph size that will be requested.
+        """
+        if self.__builder__ is None or self.__builder__.max_k < max_k:
+            self.__builder__ = GraphBuilder.from_table(self.__database__.get_vis_table(), max_k)
+        return self.__builder__
+
+
+    def __ppr_service__(self):
+        """
+        Gets the personalized PageRank service for the current graph. The transition matrix is
+        built once per graph and shared by every task 4 query against it.
+        """
+        if self.__ppr__ is None or not self.__ppr__[0] is self.__graph__:
+            G, ids = self.__graph__.get_sparse_adjacency()
+            service = PersonalizedPageRank(G, ids.tolist())
+            self.__ppr__ = (self.__graph__, service)
+        return self.__ppr__[1]
+
+
     @timed
     def task1(self, args, path='.'):
         """
@@ -171,44 +199,24 @@ class Interface():
     @timed
     def task2(self, args, path='.'):
         """
-        -task 2 --k #
+        -task 2 --k # (--alg arpack/lobpcg)
         """
         if args.k == None:
             raise ValueError('K must be defined for task 2.')
         c = int(args.k)
-        # alg = args.alg
+        solver = str(args.alg) if args.alg else 'arpack'
+        if not solver in Spectral.SOLVERS:
+            raise ValueError('Alg for task 2 must be one of %s.' % Spectral.SOLVERS)
 
         # YOUR CODE HERE.
-        clusters = {}
-        clusters1 = {}
-        images = self.__graph__.get_images()
-        list_of_clusters = []
-        list_of_clusters1 = []
-        lengOfA = 0
-        lengOfB = 0
-        lengOfClusters = {}
-        A = self.__graph__.get_adjacency()
-        D = np.diag(np.ravel(np.sum(A, axis=1)))
-        L = D - A
-        l, U = la.eigh(L)
-        f = U[:, 1]
-        labels = np.ravel(np.sign(f))
-        # Clustering function
-        for image in images:
-
-            if (labels[images.index(image)] == -1):
-                cluster = 'A'
-                clusters[image] = cluster
-                lengOfA += 1
-
-                if not cluster in list_of_clusters:
-                    list_of_clusters.append(cluster)
-            else:
-                cluster = 'B'
-                clusters[image] = cluster
-                lengOfB += 1
-                if not cluster in list_of_clusters:
-                    list_of_clusters.append(cluster)
+        A, ids = self.__graph__.get_sparse_adjacency()
+        images = ids.tolist()
+
+        # Algorithm 1 - sign of the fiedler vector.
+        labels = Spectral.fiedler_split(A, solver=solver)
+        clusters = {image: ('A' if label == -1 else 'B') for image, label in zip(images, labels)}
+        lengOfA = int(np.sum(labels == -1))
+        lengOfB = len(images) - lengOfA
 
         # display
         # for image in images:
@@ -219,19 +227,11 @@ class Interface():
         print("Clusters in A:", lengOfA)
         print("Clusters in B:", lengOfB)
 
-        #Algorithm 2
-        l1, u1 = la.eigh(A)
-        u1.sort(axis=1)
-        f1 = u1[:, -c:]
-        means, labels1 = vq.kmeans2(f1, c)
-        for j in range(c):
-            indices = [i for i, x in enumerate(labels1) if x == j]
-            lengOfClusters[j] = len(indices)
-            for everyIndice in indices:
-                cluster = j
-                clusters1[images[everyIndice]] = cluster
-            if not j in list_of_clusters1:
-                list_of_clusters1.append(j)
+        #Algorithm 2 - k-means on the spectral embedding.
+        labels1 = Spectral.kway(A, c, solver=solver)
+        clusters1 = {image: int(label) for image, label in zip(images, labels1)}
+        counts = np.bincount(labels1, minlength=c)
+        lengOfClusters = {j: int(counts[j]) for j in range(c)}
 
         # for image in images:
             # self.__graph__.add_to_cluster(image, clusters1[image])
@@ -250,52 +250,15 @@ class Interface():
         k = int(args.k)
 
         # YOUR CODE HERE.
-        G = self.__graph__.get_adjacency()
-        images = self.__graph__.get_images()
-        n = G.shape[0]
-        s = 0.86
-        maxerr = 0.01
-
-        # transform G into markov matrix A
-        A = csc_matrix(G, dtype=np.float)
-        rsums = np.array(A.sum(1))[:, 0]
-        ri, ci = A.nonzero()
-        A.data /= rsums[ri]
-
-        # bool array of sink states
-        sink = rsums == 0
-
-        # Compute pagerank r until we converge
-        ro, r = np.zeros(n), np.ones(n)
-        # account for sink states
-        Di = sink / float(n)
-        # account for teleportation to state i
-        Ei = np.ones(n) / float(n)
-        # while np.sum(np.abs(r - ro)) > maxerr:
-        for _ in range(150):
-
-            if np.sum(np.abs(r - ro)) <= maxerr:
-                break
-            ro = r.copy()
-            # calculate each pagerank at a time
-            for i in range(0, n):
-                # in-links of state i
-                Ai = np.array(A[:, i].todense())[:, 0]
-
-
-                r[i] = ro.dot(Ai * s + Di * s + Ei * (1 - s))
-
-        weights = r / float(sum(r))
-        orderedWeights = np.argsort(weights)
-        ReorderedWeights = np.flipud(orderedWeights)
-        # m = max(weights)
-        # ind = np.argmax(weights)
-        listOfImages = list()
-        for xx in range(k):
-            listOfImages.append(images[ReorderedWeights[xx]])
-        # weightDict = {}
-        # for xx in range(len(weights)):
-        #     weightDict[xx] = weights[xx]
+        G, ids = self.__graph__.get_sparse_adjacency()
+        images = ids.tolist()
+
+        # transform G into markov matrix A and rank by sparse power iteration.
+        A, sink = PageRank.transition(G)
+        result = PageRank.rank(A, sink, damping=0.86, max_iter=150)
+        print(f'PageRank converged after {result.iterations} iterations (residual {result.residual}).')
+
+        listOfImages = [images[i] for i in PageRank.top(result.scores, k)]
         print(listOfImages)
         show_images(listOfImages, self.__database__)
         save_images(listOfImages, self.__database__, join(path, 'out'))
@@ -311,54 +274,7 @@ class Interface():
         imgs = list(args.imgs)
         # 6 2976167 83 38391649 299 135049429
         # YOUR CODE HERE.
-        G = self.__graph__.get_adjacency()
-        images = self.__graph__.get_images()
-        indexes = list()
-        for x in imgs:
-            indexes.append(images.index(x))
-        n = G.shape[0]
-        s = 0.6
-        maxerr = 0.1
-
-        # transform G into markov matrix A
-        A = csc_matrix(G, dtype=np.float)
-        rsums = np.array(A.sum(1))[:, 0]
-        ri, ci = A.nonzero()
-        A.data /= rsums[ri]
-
-        # bool array of sink states
-        sink = rsums == 0
-
-        Ei = np.zeros(n)
-        for ii in indexes:
-            Ei[ii] = 1 / len(imgs)
-        # Compute pagerank r until we converge
-        ro, r = np.zeros(n), np.ones(n)
-        # while np.sum(np.abs(r - ro)) > maxerr:
-        for _ in range(100):
-
-            if np.sum(np.abs(r - ro)) <= maxerr:
-                break
-
-            ro = r.copy()
-            # calculate each pagerank at a time
-            for i in range(0, n):
-                # in-links of state i
-                Ai = np.array(A[:, i].todense())[:, 0]
-                # account for sink states
-                Di = sink / float(n)
-                # account for teleportation to state i
-
-                r[i] = ro.dot(Ai * s + Di*s + Ei * (1 - s))
-
-        weights = r / float(sum(r))
-        orderedWeights = np.argsort(weights)
-        ReorderedWeights = np.flipud(orderedWeights)
-        # m = max(weights)
-        # ind = np.argmax(weights)
-        listOfImages = list()
-        for xx in range(k):
-            listOfImages.append(images[ReorderedWeights[xx]])
+        listOfImages = self.__ppr_service__().top([imgs], k)[0]
         print(listOfImages)
         show_images(listOfImages, self.__database__)
         save_images(listOfImages, self.__database__, join(path, 'out'))
@@ -368,22 +284,43 @@ class Interface():
     def task5(self, args, path='.'):
         """
         Use as:
-        -task 5 --layers # --hashes # --k # --imageId #
+        -task 5 --layers # --hashes # --k # --imageId # (--probes # --candidates #)
+        -task 5 --layers # # ... --hashes # # ... --k # --file query/file/path (--probes # --candidates #)
+            benchmarks LSH against exact kNN for the image ids in the file, over every
+            (layers, hashes) pair given.
         """
         if args.layers == None or args.hashes == None or \
-                args.k == None or args.imageId == None:
-            raise ValueError('Layers, Hashes, Vectors, K, and IMG must all be defined for task 5.')
+                args.k == None or (args.imageId == None and args.file == None):
+            raise ValueError('Layers, Hashes, Vectors, K, and IMG (or File) must all be defined for task 5.')
 
-        layers = int(args.layers)
-        hashes = int(args.hashes)
+        # a single value is accepted in place of a list.
+        layers = [int(l) for l in np.atleast_1d(args.layers)]
+        hashes = [int(h) for h in np.atleast_1d(args.hashes)]
         t = int(args.k)
         imageId = args.imageId
+        # multi-probe settings are optional.
+        probes = getattr(args, 'probes', None) or 0
+        max_candidates = getattr(args, 'candidates', None)
         if args.vectors:
             vectors = str(args.vectors)
 
+        if args.file:
+            if not isfile(realpath(args.file)):
+                raise ValueError('File specified was not a valid file.')
+            with open(args.file, 'r') as f:
+                imageIds = [int(line.split()[0]) for line in f if not line.isspace()]
+            self.__lsh__.benchmark(imageIds, layers, hashes, t, self.__database__,
+                                   probes=probes, max_candidates=max_candidates)
+            return
+
+        if len(layers) > 1 or len(hashes) > 1:
+            raise ValueError('Only one value of layers and hashes may be given without a file. Got %s and %s.'
+                             % (layers, hashes))
+
         # YOUR CODE HERE
-        lsh = LSH()
-        nearest = lsh.main(layers, hashes, imageId, vectors=(), t=t, database=self.__database__)
+        # the index for each (layers, hashes) is built once and reused by later queries.
+        nearest = self.__lsh__.main(layers[0], hashes[0], imageId, vectors=(), t=t, database=self.__database__,
+                                    probes=probes, max_candidates=max_candidates)
         show_images(nearest, self.__database__)
         save_images(nearest, self.__database__, join(path, 'out'))
 
@@ -428,12 +365,10 @@ class Interface():
 
         elif alg == "ppr":
 
-            G = self.__graph__.get_adjacency()
-            images = self.__graph__.get_images()
-            indexes = list()
-
-            for x in imageIDs:
-                indexes.append(images.index(x))
+            G, ids = self.__graph__.get_sparse_adjacency()
+            images = ids.tolist()
+            rows = {image: i for i, image in enumerate(images)}
+            indexes = [rows[x] for x in imageIDs]
 
             ppr = PPR()
             result = ppr.ppr_algorithm(imageIDs, labels, indexes, G, images)
@@ -477,11 +412,11 @@ class Interface():
 
         # call load once.
         self.load(Args(load='dataset'))
+        # every graph size comes from one similarity pass.
+        builder = self.__graphs__(max(graphs))
 
-        # graphpath = '/home/crosleyzack/school/fall18/cse515/repo/project/phaseIII/graph/graph'
         for graph in graphs:
-            # load graph
-            self.graph(Args(graph=f'{graph}'))
+            self.__graph__ = builder.graph(graph)
 
             # Create folder for this graph size.
             working_dir = join(basepath, f'graph{graph}')
@@ -535,11 +470,11 @@ class Interface():
 
         # call load once.
         self.load(Args(load='dataset'))
+        # every graph size comes from one similarity pass.
+        builder = self.__graphs__(max(graphs))
 
-        # graphpath = '/home/crosleyzack/school/fall18/cse515/repo/project/phaseIII/graph/graph'
         for graph in graphs:
-            # load graph
-            self.graph(Args(graph=f'{graph}'))
+            self.__graph__ = builder.graph(graph)
 
             # Create folder for this graph size.
             working_dir = join(basepath, f'graph{graph}')
@@ -553,10 +488,13 @@ class Interface():
             task4_images = [[2976144, 3172496917, 2614355710], [27483765, 2492987710, 487287905]]
             # used list from submission sample.
 
-            for k, images in product(task4, task4_images):
+            # every seed set is answered in one batched pass over the graph.
+            nearest = self.__ppr_service__().top(task4_images, max(task4)) if task4 else []
+
+            for k, (images, top) in product(task4, zip(task4_images, nearest)):
                 subdir = join(task_dir, f'k{k}img{images[0]}') # include first image in dir name.
                 safe_mkdir(subdir)
-                self.task4(Args(k=k, imgs=images), path=subdir)
+                save_images(top[:k], self.__database__, join(subdir, 'out'))
 
             """
             # task 5.
@@ -596,9 +534,14 @@ class Interface():
         basepath = realpath('./precomputed')
         safe_mkdir(basepath)
 
-        graphpath = '/home/crosleyzack/school/fall18/cse515/repo/project/phaseIII/graph/graph'
-        for graph in range(3,11):
-            self.graph(Args(graph=f'{graph}'))
+        # call load once.
+        self.load(Args(load='dataset'))
+        # every graph size comes from one similarity pass.
+        graphs = range(3,11)
+        builder = self.__graphs__(max(graphs))
+
+        for graph in graphs:
+            self.__graph__ = builder.graph(graph)
 
             # Create folder for this graph size.
             working_dir = join(basepath, f'graph{graph}')
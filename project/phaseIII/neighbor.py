@@ -13,7 +13,6 @@ from sklearn.metrics.pairwise import cosine_similarity
 from numpy import union1d
 from database import Database
 from sklearn.neighbors import KNeighborsClassifier
-import pandas as pd
 
 
 # A class is implemented for this tuple to ensure that
@@ -82,23 +81,88 @@ class Neighbor():
 
 
 
+    @staticmethod
+    def knn_sparse(k, vector, store, metric='lp', p=3, exclude=None):
+        """
+        KNN over a CSR term store, using its posting lists so only the objects sharing a term \
+            with the vector are ever touched. Cost is the number of terms in the vector times \
+            the length of their posting lists, rather than the size of the table.
+
+        Like knn_textual always has, the distance only covers the terms of the vector:
+            lp - (sum over the vector's terms of |v_t - x_t|^p)^(1/p). This is sum |v_t|^p for
+                every object, adjusted by |v_t - x_t|^p - |v_t|^p on the terms they share.
+            cosine - 1 - cosine similarity.
+        Objects sharing no term with the vector all sit at the same distance, and are only
+            returned (in row order) if fewer than k objects are closer.
+        :param csr_matrix vector: (1 x terms) query vector.
+        :param TermStore store: objects to search.
+        :param str metric: 'lp' or 'cosine'.
+        :param int p: order of the lp distance.
+        :param int exclude: row to leave out of the results (the query itself).
+        :return list: DistanceMeasure for the k nearest objects, nearest first.
+        """
+        terms = vector.indices
+        values = np.asarray(vector.data, dtype=np.float64)
+        postings = store.postings()
+
+        # gather the posting list of every term in the vector as flat arrays.
+        starts = postings.indptr[terms]
+        lengths = postings.indptr[terms + 1] - starts
+        positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        rows = postings.indices[positions]
+        shared = np.asarray(postings.data[positions], dtype=np.float64)
+        query = np.repeat(values, lengths)
+        touched, inverse = np.unique(rows, return_inverse=True)
+
+        if metric == 'lp':
+            base = np.power(np.abs(values), p).sum()
+            adjust = np.bincount(inverse, weights=np.power(np.abs(query - shared), p) - np.power(np.abs(query), p),
+                                 minlength=len(touched))
+            distances = np.power(np.maximum(base + adjust, 0), 1. / p)
+            default = np.power(base, 1. / p)
+        elif metric == 'cosine':
+            dots = np.bincount(inverse, weights=query * shared, minlength=len(touched))
+            norms = store.norms()[touched] * np.sqrt(np.dot(values, values))
+            norms[norms == 0] = 1
+            distances = 1 - dots / norms
+            default = 1.
+        else:
+            raise ValueError('Invalid textual distance specified: %s' % metric)
+
+        if not exclude is None:
+            keep = touched != exclude
+            touched, distances = touched[keep], distances[keep]
+
+        nearest = []
+        if len(touched):
+            top = np.argpartition(distances, min(k, len(touched)) - 1)[:k]
+            nearest = [(distances[i], touched[i]) for i in top]
+
+        # objects without a shared term, in case fewer than k touched objects are closer.
+        if sum(1 for d, _ in nearest if d <= default) < k:
+            skip = set(touched.tolist())
+            skip.add(exclude)
+            untouched = (row for row in range(len(store)) if not row in skip)
+            nearest += [(default, row) for _, row in zip(range(k), untouched)]
+
+        nearest.sort(key=lambda pair: pair[0])
+        return [DistanceMeasure(store.ids[row], distance) for distance, row in nearest[:k]]
+
+
     @staticmethod
     @timed
-    def knn_textual(k, an_id, atype, database, processes=1):
+    def knn_textual(k, an_id, atype, database, processes=1, metric='lp'):
         """
-        KNN method for textual vectors. Performs the setup of getting the vector and table \
-            from the atype (user, photo, location), an_id (vector id) and calls KNN.
+        KNN method for textual vectors. Performs the setup of getting the vector and term \
+            store from the atype (user, photo, location), an_id (vector id) and calls knn_sparse.
         
-        The KNN cuts the vector and table to only the columns present in the vector for \
-            efficiency and because the professor seems to suggest this is acceptable.
+        The KNN only compares the terms present in the vector for efficiency and because \
+            the professor seems to suggest this is acceptable.
         """
-        vector = database.get_txt_vector(atype, an_id)
-        vec_indexes = vector.nonzero()[0]
-        vector = vector[vec_indexes]
-        table = database.get_txt_desc_table(atype).drop(vector.name)
-        table = table.iloc[:, vec_indexes]
+        store = database.get_txt_store(atype)
+        row = store.row(an_id)
 
-        return Neighbor.knn(k, vector, table, processes)
+        return Neighbor.knn_sparse(k, store.matrix[row], store, metric=metric, p=3, exclude=row)
 
 
     # KNN Specific method for visual vectors. Retrieves the appropriate table 
@@ -127,36 +191,32 @@ class Neighbor():
         return Neighbor.knn(k, vector, table, processes)
     
     @staticmethod
-    @timed
-    def knn_visual_LSH(k, this_image, database, those_images, processes=1):
+    def knn_candidates(k, vector, matrix, rows, ids=None, p=3):
         """
-        KNN Specific method for visual vectors. Retrieves the visual description table based \
-            on the imageIds passed. If locationid is None, the table is for all locations. \
-            If model is None, the table is for all visual models. If both are none, the table is \
-            for all locations and visual models. Calls KNN on vector and table derived.
-
-        The KNN cuts the vector and table to only the columns present in the vector for \
-            efficiency and because the professor seems to suggest this is acceptable.
+        KNN restricted to a subset of candidate rows, such as the ones returned by LSH. The \
+            candidates are gathered from the matrix by fancy indexing, so a query costs \
+            O(candidates * d) no matter how many rows the matrix holds.
+
+        As in knn_visual, only the columns present in the vector are compared.
+        :param numpy.ndarray vector: (d,) query vector.
+        :param numpy.ndarray matrix: (n x d) C-contiguous matrix of every object.
+        :param numpy.ndarray rows: integer positions of the candidates in matrix.
+        :param list ids: id of each row of matrix. Distances are labelled by row position if None.
+        :param int p: order of the Lp distance.
+        :return list: DistanceMeasure for the k nearest candidates, nearest first.
         """
-        # edit table to get only desired imageIds(received from LSH bucketing) to be included
-        num_comparisons = len(those_images)
-
-        whole_table = pd.DataFrame(database.get_vis_table())
-        whole_table = whole_table.T
-        whole_table = whole_table.to_dict('list')
-
-        table = {}
-        for image in those_images:
-            table[image] = whole_table[image]
-
-        table = pd.DataFrame.from_dict(table, orient='index')
-        # print(table)
-
-        vector = table.loc[this_image]
-        print(vector)
-        vec_indexes = vector.nonzero()[0]
-        vector = vector[vec_indexes]
-
-        table = table.iloc[:, vec_indexes]
-
-        return Neighbor.knn(k, vector, table, processes), num_comparisons
+        rows = np.asarray(rows, dtype=np.intp)
+        vector = np.asarray(vector, dtype=matrix.dtype)
+        columns = np.flatnonzero(vector)
+
+        candidates = matrix[rows][:, columns]
+        distances = np.power(np.power(np.abs(candidates - vector[columns]), p).sum(axis=1), 1. / p)
+
+        k = min(k, len(rows))
+        if k <= 0:
+            return []
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        if ids is None:
+            return [DistanceMeasure(rows[i], distances[i]) for i in nearest]
+        return [DistanceMeasure(ids[rows[i]], distances[i]) for i in nearest]
@@ -0,0 +1,145 @@
+#! /bin/usr/python3.6
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from collections import namedtuple
+from util import timed
+
+
+# scores are (n,) for a single teleport vector, or (n x q) when q are ranked at once.
+PageRankResult = namedtuple('PageRankResult', ['scores', 'iterations', 'residual'])
+
+
+class PageRank():
+    """
+    PageRank by power iteration, where every iteration is one sparse matrix product on a CSR
+    transition matrix instead of a python loop over the nodes.
+    """
+
+    @staticmethod
+    def transition(adjacency):
+        """
+        Row normalizes an adjacency matrix into a markov transition matrix.
+        :param adjacency: (n x n) adjacency matrix, dense or scipy.sparse. Row i holds the out
+            edges of node i.
+        :return tuple (transition, sink): CSR transition matrix and boolean array of the sink
+            states (nodes without out edges), whose rows are left empty.
+        """
+        A = csr_matrix(adjacency, dtype=np.float64)
+        rsums = np.asarray(A.sum(axis=1)).ravel()
+        sink = rsums == 0
+        inverse = np.zeros(len(rsums))
+        inverse[~sink] = 1. / rsums[~sink]
+        return csr_matrix(diags(inverse).dot(A)), sink
+
+
+    @staticmethod
+    @timed
+    def rank(transition, sink, damping=0.85, teleport=None, tol=1e-6, max_iter=100):
+        """
+        Runs power iteration until the L1 change between iterations drops below tol.
+            r = damping * (A^T r + sink mass * v) + (1 - damping) * v
+        The mass sitting on sink states is redistributed along the teleport vector v, so the
+        scores always sum to one.
+        :param csr_matrix transition: transition matrix from PageRank.transition.
+        :param numpy.ndarray sink: boolean array of sink states from PageRank.transition.
+        :param float damping: probability of following an edge rather than teleporting.
+        :param numpy.ndarray teleport: (n,) teleport distribution, or (n x q) for q distributions
+            ranked at once. Uniform if None. Each column is normalized to sum to one.
+        :param float tol: L1 convergence tolerance.
+        :param int max_iter: maximum number of iterations.
+        :return PageRankResult: scores, number of iterations run, and final L1 residual.
+        """
+        n = transition.shape[0]
+        if teleport is None:
+            teleport = np.full(n, 1. / n)
+        else:
+            teleport = np.asarray(teleport, dtype=np.float64)
+            teleport = teleport / teleport.sum(axis=0)
+
+        # transposed once so each iteration is a CSR matrix - vector product.
+        transpose = csr_matrix(transition.T)
+        r = teleport.copy()
+        residual = np.inf
+        iteration = 0
+        while iteration < max_iter and residual > tol:
+            iteration += 1
+            leaked = r[sink].sum(axis=0)
+            r_new = damping * transpose.dot(r) + (damping * leaked + (1 - damping)) * teleport
+            residual = np.max(np.abs(r_new - r).sum(axis=0))
+            r = r_new
+
+        return PageRankResult(r, iteration, residual)
+
+
+    @staticmethod
+    def top(scores, k):
+        """
+        Positions of the k highest scores, best first.
+        :param numpy.ndarray scores: (n,) scores from PageRank.rank.
+        :param int k: number of positions to return.
+        """
+        return np.argsort(-scores, kind='stable')[:k]
+
+
+class PersonalizedPageRank():
+    """
+    Personalized PageRank service for one loaded graph. The transition matrix is built once, and
+    any number of seed sets are answered together by iterating an (n x q) score matrix, so a batch
+    of q queries shares one sparse matrix pass per iteration.
+    """
+
+    def __init__(self, adjacency, images, damping=0.6, tol=1e-6, max_iter=100):
+        """
+        :param adjacency: (n x n) adjacency matrix of the graph, dense or scipy.sparse.
+        :param list images: image id of each row of the adjacency.
+        :param float damping: probability of following an edge rather than teleporting to a seed.
+        :param float tol: L1 convergence tolerance, applied to every query.
+        :param int max_iter: maximum number of iterations.
+        """
+        self.transition, self.sink = PageRank.transition(adjacency)
+        self.images = list(images)
+        self.damping = damping
+        self.tol = tol
+        self.max_iter = max_iter
+        self.__index__ = {image: i for i, image in enumerate(self.images)}
+
+
+    def seeds(self, seed_sets):
+        """
+        Builds the teleport matrix for a batch of queries. Column j is uniform over seed set j.
+        :param list seed_sets: list of lists of image ids.
+        :return numpy.ndarray: (n x q) teleport matrix.
+        """
+        teleport = np.zeros((len(self.images), len(seed_sets)))
+        for j, seed_set in enumerate(seed_sets):
+            if len(seed_set) == 0:
+                raise ValueError('Seed set %s of the query is empty.' % j)
+            try:
+                rows = [self.__index__[image] for image in seed_set]
+            except KeyError as e:
+                raise ValueError('Seed image is not in the graph: %s' % e.args[0])
+            teleport[rows, j] = 1. / len(rows)
+        return teleport
+
+
+    def rank(self, seed_sets):
+        """
+        Personalized PageRank scores for a batch of seed sets.
+        :param list seed_sets: list of lists of image ids.
+        :return PageRankResult: (n x q) scores, one column per seed set.
+        """
+        return PageRank.rank(self.transition, self.sink, damping=self.damping,
+                             teleport=self.seeds(seed_sets), tol=self.tol, max_iter=self.max_iter)
+
+
+    def top(self, seed_sets, k):
+        """
+        The k most relevant images to each seed set.
+        :param list seed_sets: list of lists of image ids.
+        :param int k: number of images to return per seed set.
+        :return list: one list of k image ids per seed set, best first.
+        """
+        result = self.rank(seed_sets)
+        print(f'Personalized PageRank converged after {result.iterations} iterations (residual {result.residual}).')
+        return [[self.images[i] for i in PageRank.top(result.scores[:, j], k)] for j in range(len(seed_sets))]
@@ -0,0 +1,103 @@
+#! /bin/usr/python3.6
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import eigsh, lobpcg
+import scipy.cluster.vq as vq
+from util import timed
+
+
+class Spectral():
+    """
+    Spectral clustering on sparse graphs. Only the few eigenvectors needed are computed, using
+    ARPACK or LOBPCG on the normalized adjacency, instead of a dense O(n^3) eigen decomposition.
+
+    The smallest eigenvectors of the normalized Laplacian L = I - D^-1/2 W D^-1/2 are the largest
+    eigenvectors of M = D^-1/2 W D^-1/2, which is what is handed to the solvers since the largest
+    end of the spectrum converges far faster.
+    """
+
+    SOLVERS = ['arpack', 'lobpcg']
+
+    @staticmethod
+    @timed
+    def laplacian(adjacency):
+        """
+        Symmetrizes a (possibly directed) adjacency and normalizes it.
+        :param adjacency: (n x n) adjacency matrix, dense or scipy.sparse.
+        :return tuple (csr_matrix, numpy.ndarray): normalized adjacency M and D^-1/2 as a vector.
+        """
+        A = csr_matrix(adjacency, dtype=np.float64)
+        W = (A + A.T) / 2
+        degree = np.asarray(W.sum(axis=1)).ravel()
+        inv_sqrt = np.zeros(len(degree))
+        inv_sqrt[degree > 0] = 1. / np.sqrt(degree[degree > 0])
+        scale = diags(inv_sqrt)
+        return csr_matrix(scale.dot(W).dot(scale)), inv_sqrt
+
+
+    @staticmethod
+    @timed
+    def eigenvectors(M, k, solver='arpack', tol=1e-6, max_iter=None):
+        """
+        The k largest eigenpairs of the normalized adjacency.
+        :param csr_matrix M: normalized adjacency from Spectral.laplacian.
+        :param int k: number of eigenvectors.
+        :param str solver: 'arpack' or 'lobpcg'.
+        :return tuple (values, vectors): eigenvalues in descending order and the (n x k) vectors.
+        """
+        if solver == 'arpack':
+            values, vectors = eigsh(M, k=k, which='LA', tol=tol, maxiter=max_iter)
+        elif solver == 'lobpcg':
+            start = np.random.RandomState(0).normal(size=(M.shape[0], k))
+            values, vectors = lobpcg(M, start, largest=True, tol=tol, maxiter=max_iter or 500)
+        else:
+            raise ValueError('Invalid eigensolver specified: %s' % solver)
+
+        order = np.argsort(-values)
+        return values[order], vectors[:, order]
+
+
+    @staticmethod
+    @timed
+    def kmeans(embedding, c):
+        """
+        Clusters the rows of a spectral embedding, keeping the best of several k-means restarts.
+        :param numpy.ndarray embedding: (n x c) embedding.
+        :param int c: number of clusters.
+        :return numpy.ndarray: cluster label of each row.
+        """
+        codebook, _ = vq.kmeans(embedding, c, iter=20)
+        labels, _ = vq.vq(embedding, codebook)
+        return labels
+
+
+    @staticmethod
+    def fiedler_split(adjacency, solver='arpack'):
+        """
+        Two way partition by the sign of the Fiedler vector of the normalized Laplacian.
+        :param adjacency: (n x n) adjacency matrix, dense or scipy.sparse.
+        :param str solver: 'arpack' or 'lobpcg'.
+        :return numpy.ndarray: -1 or 1 for each vertex (0 if it sits exactly on the split).
+        """
+        M, inv_sqrt = Spectral.laplacian(adjacency)
+        _, vectors = Spectral.eigenvectors(M, 2, solver=solver)
+        # scale back to the random walk Laplacian's eigenvector before taking the sign.
+        return np.sign(vectors[:, 1] * inv_sqrt)
+
+
+    @staticmethod
+    def kway(adjacency, c, solver='arpack'):
+        """
+        c way partition: embed each vertex with the c smallest eigenvectors of the normalized
+            Laplacian, normalize the rows, then run k-means on the embedding.
+        :param adjacency: (n x n) adjacency matrix, dense or scipy.sparse.
+        :param int c: number of clusters.
+        :param str solver: 'arpack' or 'lobpcg'.
+        :return numpy.ndarray: cluster label (0 to c - 1) of each vertex.
+        """
+        M, _ = Spectral.laplacian(adjacency)
+        _, vectors = Spectral.eigenvectors(M, c, solver=solver)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1
+        return Spectral.kmeans(vectors / norms[:, np.newaxis], c)
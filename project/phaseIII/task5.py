@@ -1,122 +1,366 @@
 import numpy as np
-import pandas as pd
-from distance import Distance
-from database import Database
+import pickle
+import hashlib
+from os.path import isfile, join, abspath
+from collections import namedtuple
+from itertools import product
+from time import perf_counter
+from util import timed, safe_mkdir
 from neighbor import Neighbor
 
 
+# one row of LSH.benchmark. Latencies are in milliseconds, candidates is the mean unique count.
+BenchmarkResult = namedtuple('BenchmarkResult', ['layers', 'hashes', 'recall', 'mean_ms', 'p95_ms', 'candidates'])
+
+
+class LSHIndex():
+    """
+    Random projection locality sensitive hashing index. Each of the L layers hashes a vector with
+    k random projections, all L * k of which are computed as one matrix multiply. The k hash values
+    of a layer are packed into a single key for that layer's bucket dictionary, so a lookup costs
+    the size of the bucket rather than the size of the dataset.
+
+    Two hash families are supported:
+        hyperplane - the sign of each projection (cosine similarity). Keys are k bit integers.
+        pstable - floor((a.x + b) / w) with gaussian a (euclidean distance). Keys are the bytes
+            of the k integer hash values.
+    """
+
+    HYPERPLANE = 'hyperplane'
+    PSTABLE = 'pstable'
+
+    def __init__(self, L, k, family=PSTABLE, width=None, seed=None):
+        """
+        :param int L: number of layers (hash tables).
+        :param int k: number of hashes per layer.
+        :param str family: 'pstable' or 'hyperplane'.
+        :param float width: bucket width w of the pstable family. Estimated from the data if None.
+        :param int seed: seed for the random projections.
+        """
+        if not family in (LSHIndex.HYPERPLANE, LSHIndex.PSTABLE):
+            raise ValueError('Invalid LSH family specified: %s' % family)
+        if family == LSHIndex.HYPERPLANE and k > 62:
+            raise ValueError('The hyperplane family packs each layer into 62 bits, k = %s is too large.' % k)
+
+        self.L = L
+        self.k = k
+        self.family = family
+        self.width = width
+        self.seed = seed
+        self.projections = None
+        self.offsets = None
+        self.tables = []
+        self.ids = []
+        self.fingerprint = None
+
+
+    @staticmethod
+    def hash_data(matrix, ids):
+        """
+        Hashes the contents of the indexed data, so an index is never reused for different data
+            of the same shape.
+        :param numpy.ndarray matrix: (n x d) vectors.
+        :param list ids: id of each row.
+        :return str: hex digest.
+        """
+        digest = hashlib.sha1()
+        digest.update(repr(np.shape(matrix)).encode())
+        digest.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+        digest.update(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+
+    def __project__(self, matrix):
+        """
+        Raw projections of every row, reshaped to (rows x L x k).
+        """
+        proj = np.atleast_2d(matrix).dot(self.projections)
+        if self.family == LSHIndex.PSTABLE:
+            proj = (proj + self.offsets) / self.width
+        return proj.reshape(-1, self.L, self.k)
+
+
+    def __codes__(self, proj):
+        """
+        Integer hash values from raw projections.
+        """
+        if self.family == LSHIndex.HYPERPLANE:
+            return (proj > 0).astype(np.int64)
+        return np.floor(proj).astype(np.int64)
+
+
+    def __pack__(self, codes):
+        """
+        Pack the (rows x k) hash values of one layer into one dictionary key per row.
+        """
+        if self.family == LSHIndex.HYPERPLANE:
+            return codes.dot(1 << np.arange(self.k, dtype=np.int64)).tolist()
+        codes = np.ascontiguousarray(codes, dtype=np.int32)
+        return [row.tobytes() for row in codes]
+
+
+    @timed
+    def build(self, matrix, ids):
+        """
+        Hash every row of the matrix into the L tables.
+        :param numpy.ndarray matrix: (n x d) vectors to index.
+        :param list ids: id of each row.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        rng = np.random.RandomState(self.seed)
+        self.projections = rng.normal(size=(matrix.shape[1], self.L * self.k)).astype(np.float32)
+        if self.family == LSHIndex.PSTABLE:
+            if self.width is None:
+                # one bucket per standard deviation of the projected data.
+                self.width = float(np.std(matrix.dot(self.projections[:, :self.k]))) or 1.
+            self.offsets = rng.uniform(0, self.width, size=self.L * self.k).astype(np.float32)
+
+        self.ids = list(ids)
+        self.fingerprint = LSHIndex.hash_data(matrix, self.ids)
+        codes = self.__codes__(self.__project__(matrix))
+        self.tables = []
+        for layer in range(self.L):
+            table = {}
+            for row, key in enumerate(self.__pack__(codes[:, layer])):
+                table.setdefault(key, []).append(row)
+            self.tables.append({key: np.array(rows) for key, rows in table.items()})
+        return self
+
+
+    def __probes__(self, proj, codes, probes):
+        """
+        Multi-probe sequence for one layer: the query's own bucket, followed by up to `probes`
+            neighboring buckets, cheapest first. A neighboring bucket changes one or two of the k
+            hash values, costed by how close the query sits to that hash's boundary.
+        :param numpy.ndarray proj: (k,) raw projections of the query in this layer.
+        :param numpy.ndarray codes: (k,) hash values of the query in this layer.
+        :param int probes: number of neighboring buckets to generate.
+        :return list: packed bucket keys in probing order.
+        """
+        keys = self.__pack__(codes[np.newaxis, :])
+        if probes <= 0:
+            return keys
+
+        # (cost, hash, new value) of every single hash perturbation.
+        if self.family == LSHIndex.HYPERPLANE:
+            single = [(abs(proj[j]), j, 1 - codes[j]) for j in range(self.k)]
+        else:
+            frac = proj - np.floor(proj)
+            single = [(frac[j], j, codes[j] - 1) for j in range(self.k)] + \
+                     [(1 - frac[j], j, codes[j] + 1) for j in range(self.k)]
+        single.sort(key=lambda p: p[0])
+
+        perturbations = [(cost, ((j, value),)) for cost, j, value in single]
+        for a in range(len(single)):
+            for b in range(a + 1, len(single)):
+                if single[a][1] != single[b][1]:
+                    perturbations.append((single[a][0] + single[b][0], (single[a][1:], single[b][1:])))
+        perturbations.sort(key=lambda p: p[0])
+
+        for _, changes in perturbations[:probes]:
+            probe = codes.copy()
+            for j, value in changes:
+                probe[j] = value
+            keys.extend(self.__pack__(probe[np.newaxis, :]))
+        return keys
+
+
+    def candidates(self, vector, probes=0, max_candidates=None):
+        """
+        Rows sharing a bucket with the vector in at least one layer. With multi-probe, each layer
+            also checks its `probes` nearest neighboring buckets. Buckets are visited in rounds,
+            the home bucket of every layer first, until the probes or the candidate budget run out.
+        :param numpy.ndarray vector: (d,) query vector.
+        :param int probes: number of extra buckets to check per layer.
+        :param int max_candidates: at most this many unique candidates are returned. The bucket
+            that fills the budget is only scanned up to the row that fills it. No limit if None.
+        :return tuple (rows, unique, total): unique candidate rows, their count, and the
+            non-unique count over every bucket row examined.
+        """
+        proj = self.__project__(np.asarray(vector, dtype=np.float32))[0]
+        codes = self.__codes__(proj)
+        sequences = [self.__probes__(proj[layer], codes[layer], probes) for layer in range(self.L)]
+
+        taken = np.zeros(len(self.ids), dtype=bool)
+        unique = 0
+        total = 0
+        for step in range(probes + 1):
+            for layer, table in enumerate(self.tables):
+                if max_candidates is not None and unique >= max_candidates:
+                    break
+                if step >= len(sequences[layer]) or not sequences[layer][step] in table:
+                    continue
+                bucket = table[sequences[layer][step]]
+                fresh = ~taken[bucket]
+                if max_candidates is not None and unique + fresh.sum() > max_candidates:
+                    # cut the bucket just after the row that fills the budget.
+                    cut = np.flatnonzero(fresh)[max_candidates - unique - 1] + 1
+                    bucket, fresh = bucket[:cut], fresh[:cut]
+                taken[bucket] = True
+                unique += int(fresh.sum())
+                total += len(bucket)
+
+        return np.flatnonzero(taken), unique, total
+
+
+    def save(self, location):
+        """
+        Saves index to binary for reuse by later queries.
+        :param path location: location to save to.
+        """
+        with open(location, 'wb+') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load index from binary.
+        :param path location: location to read from.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with open(location, 'rb') as f:
+            return pickle.load(f)
+
+
+
 class LSH():
 
-    def get_random_vectors(self, L, k):
-        random_vectors = {}
-        for i in range(L):
-            for j in range(k):
-                random_vectors[i, j] = np.random.randint(0, 9, size=(2, 945)) * 0.1
-        return random_vectors
-
-    def get_distances(self, vectors, image_dict):
-        results = {}
-        result = []
-        for i in vectors:
-            print("Working on hash" + str(i))
-            dist = {}
-            projection = []
-            for image in image_dict:
-                a = np.array(vectors[i], dtype=np.float)
-                b = a[1]
-                a = a[0]
-                p = np.array(image_dict[image], dtype=np.float)
-                ap = p - a
-                ab = b - a
-                # distance = np.array(np.around((ab * ap) / Distance.E2_distance(a, b), decimals=4))
-                projection.append(np.array(np.around((a + np.dot(ab, ap) / np.dot(ab, ab) * ab), decimals=3)))
-                # projection.append(np.array(np.around()))
-            min_proj = np.amin(projection, axis=0)
-            image_keys = list(image_dict.keys())
-            j = 0
-            # print(min_proj)
-            for x in projection:
-                distance = Distance.E2_distance(min_proj, x)
-                ind = image_keys[j]
-                dist[ind] = distance
-                j = j + 1
-            result.append(dist)
-            results['h' + str(i)] = result
-            result = []
-        # print(results)
+    def __init__(self, subdir='saved'):
+        self.subdir = subdir
+        self.indexes = {}
+        self.store = None # feature store the fingerprint was computed for.
+        self.fingerprint = None
+
+
+    def get_index(self, L, k, database):
+        """
+        Get the index with L layers and k hashes. Reuses the in memory index, then the one saved to
+        disk, and only builds (and saves) a new index if neither exists for the current data.
+        :param int L: number of layers.
+        :param int k: number of hashes per layer.
+        :param Database database:
+        """
+        features = database.get_features()
+        if not self.store is features:
+            # hashed once per store rather than on every query.
+            self.store = features
+            self.fingerprint = LSHIndex.hash_data(features.matrix, features.ids)
+        if (L, k) in self.indexes and self.indexes[L, k].fingerprint == self.fingerprint:
+            return self.indexes[L, k]
+
+        safe_mkdir(self.subdir)
+        location = abspath(join(self.subdir, f'lsh_L{L}_k{k}.pickle'))
+        index = None
+        if isfile(location):
+            index = LSHIndex.load(location)
+            if getattr(index, 'fingerprint', None) != self.fingerprint:
+                index = None # saved for different data.
+
+        if index is None:
+            index = LSHIndex(L, k).build(features.matrix, features.ids.tolist())
+            index.save(location)
+
+        self.indexes[L, k] = index
+        return index
+
+
+    def query(self, L, k, imageId, t, database, probes=0, max_candidates=None):
+        """
+        The t nearest images to imageId among the LSH candidates.
+        :param int L: number of layers.
+        :param int k: number of hashes per layer.
+        :param int imageId: query image.
+        :param int t: number of images to return.
+        :param Database database:
+        :param int probes: extra buckets to check per layer (multi-probe).
+        :param int max_candidates: candidate budget. No limit if None.
+        :return tuple (nearest, unique, total): DistanceMeasure list of the t nearest, and the
+            unique and non-unique number of candidates examined.
+        """
+        index = self.get_index(L, k, database)
+        features = database.get_features()
+        vector = features.vector(imageId)
+
+        # get all the rows which are in the same bucket as the given imageId
+        rows, unique, total = index.candidates(vector, probes=probes, max_candidates=max_candidates)
+
+        # calculate similarity over just those rows and get t nearest images
+        nearest = Neighbor.knn_candidates(t, vector, features.matrix, rows, index.ids)
+        return nearest, unique, total
+
+
+    def exact(self, imageIds, t, database):
+        """
+        Exact t nearest neighbors of each query by Neighbor.knn over the whole table, using the
+        same distance and columns as the LSH queries.
+        :param list imageIds: query images.
+        :param int t: number of neighbors.
+        :param Database database:
+        :return tuple (nearest, latencies): list of neighbor id lists, and seconds per query.
+        """
+        features = database.get_features()
+        table = features.frame()
+
+        nearest = []
+        latencies = []
+        for imageId in imageIds:
+            row = features.row(imageId)
+            start = perf_counter()
+            vector = table.iloc[row]
+            columns = vector.values.nonzero()[0]
+            found = Neighbor.knn(t, vector.iloc[columns], table.iloc[:, columns])
+            latencies.append(perf_counter() - start)
+            nearest.append([n.id for n in found])
+        return nearest, latencies
+
+
+    def benchmark(self, imageIds, layers, hashes, t, database, probes=0, max_candidates=None):
+        """
+        Compares LSH against exact kNN for a batch of queries and every (layers, hashes) pair. The
+        indexes are built (or loaded) before timing, so latencies cover only the queries.
+        :param list imageIds: query images.
+        :param list layers: values of L to sweep.
+        :param list hashes: values of k to sweep.
+        :param int t: number of neighbors per query.
+        :param Database database:
+        :param int probes: extra buckets to check per layer (multi-probe).
+        :param int max_candidates: candidate budget. No limit if None.
+        :return list: BenchmarkResult for each (layers, hashes) pair, the exact search first
+            (with layers and hashes set to None).
+        """
+        truth, latencies = self.exact(imageIds, t, database)
+        latencies = np.array(latencies) * 1000
+        results = [BenchmarkResult(None, None, 1., latencies.mean(), np.percentile(latencies, 95), len(database.get_features()))]
+
+        for L, k in product(layers, hashes):
+            self.get_index(L, k, database)
+            recall = []
+            latencies = []
+            candidates = []
+            for imageId, exact in zip(imageIds, truth):
+                start = perf_counter()
+                nearest, unique, _ = self.query(L, k, imageId, t, database,
+                                                probes=probes, max_candidates=max_candidates)
+                latencies.append(perf_counter() - start)
+                candidates.append(unique)
+                recall.append(len(set(n.id for n in nearest) & set(exact)) / len(exact))
+            latencies = np.array(latencies) * 1000
+            results.append(BenchmarkResult(L, k, np.mean(recall), latencies.mean(),
+                                           np.percentile(latencies, 95), np.mean(candidates)))
+
+        print(f'{len(imageIds)} queries, t = {t}, probes = {probes}, candidate budget = {max_candidates}')
+        print('layers\thashes\trecall@t\tmean ms\tp95 ms\tcandidates')
+        for r in results:
+            name = 'exact\t' if r.layers is None else f'{r.layers}\t{r.hashes}'
+            print(f'{name}\t{r.recall:.3f}\t\t{r.mean_ms:.2f}\t{r.p95_ms:.2f}\t{r.candidates:.1f}')
         return results
 
 
-    def get_buckets(self, results, num_buckets=4):
-        buckets = {}
-        for result in results:
-            hash = results[result]
-            for images in hash:
-                # print(images)
-                distances = list(images.values())
-                # print(distances)
-                distances = np.around(np.array(distances, dtype=np.float), decimals=3)
-                dist = (np.amax(distances) - np.amin(distances)) / num_buckets
-                bucket_range = range(int(np.amin(distances)), int(np.amax(distances)), int(dist))
-                # print(bucket_range)
-                bucket = {}
-                for i in range(num_buckets):
-                    bucket[str(i)] = []
-                for image in images:
-                    # print(images[image])
-                    x = images[image]
-                    j = -1
-                    for b in bucket_range:
-                        # print(b)
-                        if x < b:
-                            bucket[str(j)].append(image)
-                            break
-                        j = j + 1
-                buckets[result] = bucket
-                break
-        # print(buckets)
-        return buckets
-
-    def get_index_structure(self, L, k, image_dict):
-
-        random_vectors = self.get_random_vectors(L, k)
-
-        # projection code
-        results = self.get_distances(random_vectors, image_dict)
-
-        # bucketing code
-        num_buckets = 5
-        buckets = self.get_buckets(results, num_buckets)
-
-        return buckets, random_vectors
-
-    def main(self, L=2, k=3, imageId=5175916261, vectors=[], t=5, database=()):
-        # imageId = imageId[0]
-        # imageId = int(imageId[1:-1])
-        image_dict = pd.DataFrame(database.get_vis_table())
-        image_dict = image_dict.T
-        image_dict = image_dict.to_dict('list')
-
-        index_structure, vectors = self.get_index_structure(L, k, image_dict)
-        # print(index_structure['h(0, 0)'])
-
-        # get all the imageIds which are in the same bucket as the given imageId
-        imageId_set = set(image_dict.keys())
-        # print(imageId_set)
-        num_total_images = 0
-        for i in range(L):
-            for j in range(k):
-                temp_imageId = set()
-                for bucket in index_structure['h(' + str(i) + ', ' + str(j) + ')']:
-                    if imageId in index_structure['h(' + str(i) + ', ' + str(j) + ')'][str(bucket)]:
-                        temp_imageId = temp_imageId.intersection(set(index_structure['h(' + str(i) + ', ' + str(j) + ')'][str(bucket)]))
-                    num_total_images = num_total_images + len(temp_imageId)
-                imageId_set = imageId_set.union(temp_imageId)
-        # print(imageId_set)
-
-        # calculate similarity and get t nearest images
-
-        nearest, num_comparisons = Neighbor.knn_visual_LSH(t, imageId, database, list(imageId_set))
+    def main(self, L=2, k=3, imageId=5175916261, vectors=[], t=5, database=(), probes=0, max_candidates=None):
+        nearest, num_comparisons, num_total_images = self.query(L, k, imageId, t, database,
+                                                                probes=probes, max_candidates=max_candidates)
         print("Number of non-unique images considered\t: " + str(num_total_images))
         print("Number of unique images compared\t: " + str(num_comparisons))
         for image in nearest:
@@ -1,71 +1,75 @@
-import operator
-from distance import Similarity
-from distance import Distance
-import pandas as pd
 from util import timed, show_images
-from scipy.sparse import csc_matrix
 import numpy as np
+from pagerank import PageRank
 
 
 class KNN:
 
-    def get_neighbors(self, labelled_set, labels, imageInstance, k):
-        distances = []
-        j = 0
-        for x in range(len(labelled_set)):
-            # dist = Similarity.cos_similarity(imageInstance, labelled_set[x])
-            dist = Distance.E2_distance(imageInstance, labelled_set[x])
-            distances.append((labelled_set[x], labels[j], dist))
-            j += 1
-        distances.sort(key=operator.itemgetter(2), reverse=False)
-        neighbors = []
-        for x in range(k):
-            neighbors.append(distances[x][1])
-        # print("neighbors:" + str(neighbors))
-        return neighbors
-
-    def get_response(self, neighbors):
-        class_votes = {}
-        for x in range(len(neighbors)):
-            response = neighbors[x]
-            if response in class_votes:
-                class_votes[response] += 1
-            else:
-                class_votes[response] = 1
-        sorted_votes = sorted(class_votes.items(), key=operator.itemgetter(1), reverse=True)
-        return sorted_votes[0][0]
-
-    def get_labelled_set(self, imageIDs, image_dict):
-        labelled_set = []
-        for imageID in imageIDs:
-            labelled_set.append(image_dict[int(imageID)])
-        return labelled_set
+    @staticmethod
+    def classify(labelled_set, codes, unlabelled_set, k, block=1024):
+        """
+        Batched k nearest neighbor vote. Euclidean distances from a block of unlabelled rows to
+        every labelled row are computed as one matrix product, the k nearest are taken with a
+        stable argsort (so equal distances keep the lowest labelled rows), and the labels are counted with a single bincount. A tie in the vote goes to
+        the tied label of the nearest neighbor.
+        :param numpy.ndarray labelled_set: (m x d) labelled vectors, of any float precision.
+        :param numpy.ndarray codes: (m,) integer label of each labelled vector.
+        :param numpy.ndarray unlabelled_set: (n x d) vectors to classify.
+        :param int k: number of neighbors that vote.
+        :param int block: number of unlabelled rows per distance block.
+        :return numpy.ndarray: (n,) winning label code of each unlabelled vector.
+        """
+        # float64, since the expanded distance cancels badly in float32 for large offsets.
+        labelled_set = np.asarray(labelled_set, dtype=np.float64)
+        k = min(k, len(labelled_set))
+        num_labels = int(codes.max()) + 1
+        labelled_sq = np.einsum('ij,ij->i', labelled_set, labelled_set)
+        result = np.empty(len(unlabelled_set), dtype=np.intp)
+
+        for start in range(0, len(unlabelled_set), block):
+            rows = np.asarray(unlabelled_set[start:start + block], dtype=np.float64)
+            # squared distance |u|^2 + |l|^2 - 2 u.l; the ordering is all that matters.
+            dist = labelled_sq[np.newaxis, :] - 2 * rows.dot(labelled_set.T)
+            # a full stable sort, as the labelled set is small and ties must keep the lowest rows.
+            nearest = np.argsort(dist, axis=1, kind='mergesort')[:, :k]
+            index = np.arange(len(rows))[:, np.newaxis]
+            nearest_codes = codes[nearest]
+
+            # offset each row's votes so one bincount tallies the whole block.
+            offsets = index * num_labels
+            votes = np.bincount((offsets + nearest_codes).ravel(), minlength=len(rows) * num_labels)
+            votes = votes.reshape(len(rows), num_labels)
+
+            # rank of the nearest neighbor carrying each label, k if none does.
+            first = np.full((len(rows), num_labels), k)
+            for rank in range(k - 1, -1, -1):
+                first[index[:, 0], nearest_codes[:, rank]] = rank
+            result[start:start + len(rows)] = (votes * (k + 1) - first).argmax(axis=1)
+
+        return result
 
     @timed
     def knn_algorithm(self, imageIds, labels, k, database):
-        image_dict = pd.DataFrame(database.get_vis_table())
-        image_dict = image_dict.T
-        image_dict = image_dict.to_dict('list')
+        features = database.get_features()
+        images = features.ids.tolist()
+        matrix = features.matrix
+
+        set_labels = sorted(set(labels))
+        ind_labels = {l: itr for itr, l in enumerate(set_labels)}
 
         labelled = {}
-        for j, imageId in enumerate(imageIds):
-            labelled[imageId] = labels[j]
-            # labelled.append({imageId: labels[j]})
-        # print(labelled)
+        for imageId, label in zip(imageIds, labels):
+            labelled[int(imageId)] = label
+
+        labelled_ids = list(labelled.keys())
+        labelled_set = matrix[features.rows(labelled_ids)]
+        codes = np.array([ind_labels[labelled[imageId]] for imageId in labelled_ids])
 
-        labelled_set = self.get_labelled_set(imageIds, image_dict)
+        unlabelled = [i for i, image in enumerate(images) if not image in labelled]
         print("Working")
-        for v, image in enumerate(image_dict):
-            image = int(image)
-            if image not in labelled:
-                neighbors = self.get_neighbors(labelled_set, labels, image_dict[image], k)
-                result = self.get_response(neighbors)
-                # print(str(v) + " labelled as :" + str(result))
-                labels.append(result)
-                imageIds.append(image)
-                labelled[image] = result
-                # labelled.append({image: result})
-                # labelled_set.append(image_dict[image])
+        result = KNN.classify(labelled_set, codes, matrix[unlabelled], k)
+        for i, label_id in zip(unlabelled, result):
+            labelled[images[i]] = set_labels[label_id]
 
         return labelled
 
@@ -89,80 +93,37 @@ class KNN:
         
         
 class PPR:
-    
-    @timed
-    def ppr_algorithm(self, imageIDs, labels, indexes, G, images):
 
-        labelled = {}
-        for j, imageId in enumerate(imageIDs):
-            labelled[imageId] = labels[j]
-
-        num_labels = len(set(labels))
-        set_labels = frozenset(labels)
-        ind_labels = {}
-        for itr, l in enumerate(set_labels):
-            ind_labels[l] = itr
-        # print("ind_label" + str(ind_labels))
-
-        for x in imageIDs:
-            indexes.append(images.index(x))
-        n = G.shape[0]
-        s = 0.86
-        maxerr = 0.1
-
-        # transform G into markov matrix A
-        A = csc_matrix(G, dtype=np.float)
-        rsums = np.array(A.sum(1))[:, 0]
-        ri, ci = A.nonzero()
-        A.data /= rsums[ri]
-
-
-        temp = 1 / num_labels
-        r_labels = np.array([temp] * num_labels * n)
-        r_labels = r_labels.reshape(n, num_labels)
-
-        # account for seed teleportation
-        a = 0
-        Ei = np.zeros(n)
-        for ii in indexes:
-            if a > (len(imageIDs) - 1):
-                break
-            Ei[ii] = (1 / len(imageIDs))
-            this_image = imageIDs[a]
-            current_label = labelled[this_image]
-            ind = int(ind_labels[current_label])
-            r_labels[ii] = np.zeros(num_labels)
-            r_labels[ii][ind] = 1
-            a += 1
-
-        # Compute pagerank r until we converge
-        ro, r = np.zeros(n), np.ones(n)
-
-        # while np.sum(np.abs(r - ro)) > maxerr:
-        for out_itr in range(10):
-
-            if np.sum(np.abs(r - ro)) <= maxerr:
-                break
-
-            print(f'Working: {out_itr}')
-
-            ro = r.copy()
-            # calculate each pagerank at a time
-            for i in range(0, n):
-                # in-links of state i
-                # print("Working: " + str(out_itr) + " : " + str(i))
-                Ai = np.array(A[:, i].todense())[:, 0]
-                max_ind = int(np.argmax(Ai))
-                r_labels[i, :] = np.sum([r_labels[i, :], r_labels[max_ind, :]], axis=0)
-                r[i] = ro.dot(Ai * s + Ei * (1 - s))
-
-        itr = 0
-        labelled = {}
-        for image in images:
-            label_id = np.argmax(r_labels[itr])
-            label = list(ind_labels.keys())[list(ind_labels.values()).index(label_id)]
-            labelled[image] = label
-            itr += 1
+    @timed
+    def ppr_algorithm(self, imageIDs, labels, indexes, G, images, damping=0.86, tol=1e-6, max_iter=100):
+        """
+        Labels every image in the graph. One personalized PageRank per label, seeded on the images
+        given that label, is run as a single sparse (n x L) iteration, and each image then takes
+        the label whose PageRank scores it highest.
+        :param list imageIDs: labelled image ids.
+        :param list labels: label of each labelled image.
+        :param list indexes: row of each labelled image in G.
+        :param G: (n x n) adjacency matrix, dense or scipy.sparse.
+        :param list images: image id of each row of G.
+        :return dict: image id -> label for every image.
+        """
+        set_labels = sorted(set(labels))
+        ind_labels = {l: itr for itr, l in enumerate(set_labels)}
+
+        # column j teleports uniformly to the seeds carrying label j.
+        seeds = np.zeros((len(images), len(set_labels)))
+        for ii, label in zip(indexes, labels):
+            seeds[ii, ind_labels[label]] = 1
+
+        A, sink = PageRank.transition(G)
+        result = PageRank.rank(A, sink, damping=damping, teleport=seeds, tol=tol, max_iter=max_iter)
+        print(f'Label propagation converged after {result.iterations} iterations (residual {result.residual}).')
+
+        best = np.argmax(result.scores, axis=1)
+        labelled = {image: set_labels[label_id] for image, label_id in zip(images, best)}
+        # the given labels always stand.
+        for imageId, label in zip(imageIDs, labels):
+            labelled[imageId] = label
 
         return labelled
 